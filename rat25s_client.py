@@ -0,0 +1,122 @@
+import json
+import socket
+import sys
+
+# Where rat25s_parser.py --serve listens by default
+SERVE_SOCKET = ".rat25s.sock"
+
+
+
+
+def compile_remote(source, options=(), path=SERVE_SOCKET):
+    """Send source text and options to the compile server listening at path; return its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(json.dumps({"source": source, "options": list(options)}).encode("utf-8"))
+        # The server reads the request up to here
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = client.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks))
+
+
+
+
+# A copy of rat25s_parser.address_ranges(), so the client does not import the
+# parser; the two must stay in sync for outputs to match
+def address_ranges(addresses):
+    """Sorted addresses as text, with runs of consecutive ones written first-last."""
+    runs = []
+    for address in addresses:
+        if runs and address == runs[-1][1] + 1:
+            runs[-1][1] = address
+        else:
+            runs.append([address, address])
+    return ", ".join(str(first) if first == last else f"{first}-{last}" for first, last in runs)
+
+
+
+
+def write_output(out, reply):
+    """Write a reply as an output file: its errors and warnings, then the symbol table, code analysis and listing."""
+    for line in reply.get("diagnostics", []):
+        out.write(line + "\n")
+    out.write("\nSymbol Table:\n")
+    out.write(f"{'Identifier':<20}{'MemoryLocation':<20}Type\n")
+    for name, address, var_type in reply.get("symbols", []):
+        out.write(f"{name:<20}{address:<20}{var_type:<20}\n")
+
+    if "max_stack_depth" in reply:
+        addresses = reply["memory"]
+        out.write("\nCode Analysis:\n")
+        out.write(f"{'Max Stack Depth':<20}{reply['max_stack_depth']}\n")
+        out.write(f"{'Memory Used':<20}{len(addresses)}")
+        if addresses:
+            out.write(f" ({address_ranges(addresses)})")
+        out.write("\n")
+
+    out.write("\nAssembly Code Listing:\n")
+    for i, instruction in enumerate(reply.get("assembly", [])):
+        out.write(f"{i + 1:<10} {instruction}\n")
+
+
+
+
+def main():
+    # Options start with "-"; --socket picks the server and the rest are sent with the source
+    options = [arg for arg in sys.argv[1:] if arg.startswith("-")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+    if len(args) < 1:
+        print("Usage: python rat25s_client.py <input file> [output file] [-O1] [--socket=PATH]")
+        return
+
+    inputfile = args[0]
+    outputfile = "parser_output.txt" if len(args) < 2 else args[1]
+    path = SERVE_SOCKET
+    for option in options:
+        if option.startswith("--socket="):
+            path = option.partition("=")[2]
+    options = [option for option in options if not option.startswith("--socket=")]
+
+    print(f"Parsing {inputfile}...")
+    try:
+        with open(inputfile, "r") as f:
+            source = f.read()
+    except Exception as e:
+        print(f"Error reading input file: {e}")
+        return
+
+    try:
+        reply = compile_remote(source, options, path)
+    except (OSError, ValueError) as e:
+        print(f"Error talking to the compile server at {path}: {e}")
+        return
+    if "failure" in reply:
+        print(reply["failure"])
+        if "errors" not in reply:
+            return
+    else:
+        print(f"Parsing complete in {reply['elapsed']:.3f}s")
+
+    try:
+        with open(outputfile, "w", encoding="utf-8") as out:
+            write_output(out, reply)
+        print(f"Output written to {outputfile}")
+    except Exception as e:
+        print(f"Error writing output file: {e}")
+        return
+
+    if reply["errors"] > 0:
+        print(f"Parsing completed with {reply['errors']} errors. See {outputfile} for details.")
+    else:
+        print(f"Parsing completed successfully. Output written to {outputfile}")
+
+
+
+
+if __name__ == "__main__":
+    main()
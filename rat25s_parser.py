@@ -1,240 +1,1754 @@
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import gc
+import gzip
+import hashlib
+import io
+import mmap
+import os
+import pickle
+import re
+import tempfile
+import time
+
 DEBUG = True
 
 
 
 
 class Token:
-    def __init__(self, token_type, lexeme, line_number=1):
+    __slots__ = ("type", "lexeme", "line_number", "symbol")
+
+    def __init__(self, token_type, lexeme, line_number=1, symbol=None):
         self.type = token_type
         self.lexeme = lexeme
         self.line_number = line_number
-   
+        self.symbol = symbol  # Interned ID of an identifier, None otherwise
+
     def __str__(self):
         return f"Token: {self.type:<15} Lexeme: {self.lexeme}"
 
 
-def lexer(source):
-    tokens = []
-    i = 0
+# What the parser sees past the last token.  It is shared, so its line number
+# means nothing; the parser's current_line is the line the input ended on.
+EOF_TOKEN = Token("EOF", "", 0)
+
+
+class TokenView:
+    """Token-compatible view of one entry of a TokenStream.
+
+    Fixed lexemes (keywords, operators, separators) are shared strings;
+    the others are sliced from the source, and decoded if it is bytes,
+    the first time they are read.
+    """
+    __slots__ = ("type", "line_number", "lexeme", "symbol", "source", "start", "end")
+
+    def __init__(self, token_type, line_number, lexeme, symbol=None, source=None, start=0, end=0):
+        self.type = token_type
+        self.line_number = line_number
+        if lexeme is not None:
+            self.lexeme = lexeme
+        self.symbol = symbol
+        self.source = source
+        self.start = start
+        self.end = end
+
+    def __getattr__(self, name):
+        # Only reached for a lexeme left unset, so reading one that is set costs no call
+        if name != "lexeme":
+            raise AttributeError(name)
+        lexeme = self.source[self.start:self.end]
+        if not isinstance(lexeme, str):
+            lexeme = lexeme.decode("ascii")
+        self.lexeme = lexeme
+        return lexeme
+
+    def __str__(self):
+        return f"Token: {self.type:<15} Lexeme: {self.lexeme}"
+
+
+class Interner:
+    """Gives every distinct identifier a small integer ID.
+
+    The lexer interns identifiers as it finds them, so the parser's scope,
+    function and address tables can be keyed by these IDs instead of by
+    the names themselves.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.byte_ids = {}  # IDs of names seen as bytes by scanMappedTokens()
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        symbol = self.ids.get(name)
+        if symbol is None:
+            symbol = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return symbol
+
+    def intern_bytes(self, name):
+        symbol = self.byte_ids.get(name)
+        if symbol is None:
+            symbol = self.byte_ids[name] = self.intern(name.decode("ascii"))
+        return symbol
+
+    def name(self, symbol):
+        return self.names[symbol]
+
+
+# Identifiers from every source lexed in this process
+SYMBOLS = Interner()
+
+
+# Lexeme tables - hashed so every lookup is a single probe
+KEYWORDS = frozenset(["if", "else", "endif", "while", "endwhile", "for",
+                      "function", "return", "integer", "boolean",
+                      "print", "scan", "true", "false"])
+OPERATORS = frozenset(["==", "!=", "<=", "=>", "+", "-", "*", "/", "=", "<", ">"])
+SEPARATORS = frozenset([",", ";", "(", ")", "{", "}", "$$"])
+COMMENT_CLOSERS = {"/*": "*/", "[*": "*]"}
+
+# Token kinds stored by TokenStream: a type plus, for keywords, operators
+# and separators, the one lexeme that kind always has
+TOKEN_KINDS = ([("identifier", None), ("integer", None), ("error", None), ("invalid", None)]
+               + [("keyword", keyword) for keyword in sorted(KEYWORDS)]
+               + [("separator", separator) for separator in sorted(SEPARATORS)]
+               + [("operator", operator) for operator in sorted(OPERATORS)])
+KIND_IDENTIFIER = 0
+KIND_INTEGER = 1
+KIND_ERROR = 2
+KIND_INVALID = 3
+KIND_TYPES = [token_type for token_type, _ in TOKEN_KINDS]
+KIND_LEXEMES = [lexeme for _, lexeme in TOKEN_KINDS]
+# The start of a token's line in the trace, by token type
+TOKEN_PREFIXES = {token_type: f"Token: {token_type:<15} Lexeme: " for token_type in KIND_TYPES}
+LEXEME_KINDS = {lexeme: kind for kind, lexeme in enumerate(KIND_LEXEMES) if lexeme is not None}
+
+# Character classes for the first character of a lexeme
+CH_NEWLINE = 0
+CH_SPACE = 1
+CH_ALPHA = 2
+CH_DIGIT = 3
+CH_DOT = 4
+CH_SEPARATOR = 5
+CH_OPERATOR = 6
+CH_OPENER = 7     # "/", "[" or "$" - may start a comment or $$
+CH_OTHER = 8
+
+# Characters an identifier is made of
+IDENTIFIER = re.compile(r"\w+")
+
+# Every lexeme in one pattern, whose alternatives are tried in order;
+# scanTokens() dispatches on the name of the group that matched.  A word or
+# integer only matches if a lexeme run would end there too, and anything
+# the named alternatives miss is a run of characters up to the next delimiter.
+LEXEME = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<word>[A-Za-z][A-Za-z0-9_]*(?=[ \n(){};,]|\$\$|\Z))
+  | (?P<separator>[(){};,]|\$\$)
+  | (?P<operator>[=!<]=|=>|[+\-*=<>]|/(?!\*))
+  | (?P<integer>[0-9]+(?=[ \n(){};,]|\$\$|\Z))
+  | (?P<comment>/\*[^*]*\*+(?:[^/*][^*]*\*+)*/|\[\*[^*]*\*+(?:[^\]*][^*]*\*+)*\])
+  | (?P<unclosed>/\*|\[\*)
+  | (?P<run>.(?:[^ \n(){};,$]|\$(?!\$))*)
+""", re.VERBOSE | re.DOTALL)
+
+# No keyword is longer than this, so longer lexemes skip the keyword lookup
+KEYWORD_MAX_LENGTH = max(len(keyword) for keyword in KEYWORDS)
+
+# Characters read per chunk by iter_tokens() and from a trace spool, and
+# tokens lexed per batch by iter_mapped_tokens()
+CHUNK_SIZE = 64 * 1024
+BATCH_SIZE = 4096
+
+# Tokens a streaming Parser keeps buffered
+WINDOW_SIZE = 256
+
+# Lines of trace a TraceWriter keeps in memory before spooling them to
+# disk, and bytes buffered on the way to the output file
+SPOOL_LINES = 1 << 16
+REPORT_BUFFER_SIZE = 1 << 16
+
+# Endings --batch gives the output files it compresses
+COMPRESSED_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# Globals are laid out one word apart from this address
+MEMORY_BASE = 10000
+
+# Parsed $$ sections kept by a SectionCache, and where --cache keeps them.
+# Bump the version whenever what a section records or emits changes.
+SECTION_CACHE_SIZE = 256
+SECTION_CACHE_FILE = ".rat25s_sections.cache"
+SECTION_CACHE_VERSION = 3
+
+# Code for an error in the events of a recorded section; production IDs are below it
+ERROR_EVENT = 1 << 16
+
+
+def classifyChar(char):
+    """Character class of char, using the same str predicates as the language rules."""
+    if char == "\n":
+        return CH_NEWLINE
+    if char.isspace():
+        return CH_SPACE
+    if char in "/[$":
+        return CH_OPENER
+    if char.isalpha():
+        return CH_ALPHA
+    if char == ".":
+        return CH_DOT
+    if char.isdigit():
+        return CH_DIGIT
+    if char in SEPARATORS:
+        return CH_SEPARATOR
+    if char in "=!<>+-*":
+        return CH_OPERATOR
+    return CH_OTHER
+
+
+# Precomputed table for ASCII; anything else is classified on the fly
+CHAR_CLASS = {chr(code): classifyChar(chr(code)) for code in range(128)}
+
+# Byte-level tables for scanMappedTokens(); the text it mirrors has had
+# \r\n and \r translated to \n, so \r counts as a newline and a delimiter
+BYTE_CLASS = [classifyChar(chr(code)) for code in range(128)]
+BYTE_CLASS[ord("\r")] = CH_NEWLINE
+BYTE_LEXEME_KINDS = {lexeme.encode(): kind for lexeme, kind in LEXEME_KINDS.items()}
+BYTE_COMMENT_CLOSERS = {opener.encode(): closer.encode() for opener, closer in COMMENT_CLOSERS.items()}
+BYTE_WHITESPACE_RUN = re.compile(rb"[\t\n\x0b\x0c\r\x1c-\x1f ]+")
+BYTE_NEWLINE = re.compile(rb"\r\n?|\n")
+BYTE_LEXEME_RUN = re.compile(rb"(?:[^ \n\r(){};,$]|\$(?!\$))*")
+BYTE_IDENTIFIER = re.compile(rb"[A-Za-z0-9_]+")
+BYTE_DIGITS = re.compile(rb"[0-9]+")
+NON_ASCII = re.compile(rb"[\x80-\xff]")
+
+
+class TokenStream:
+    """Compact token store with one entry per token in parallel arrays.
+
+    Each token is a kind code (an index into TOKEN_KINDS), a start offset
+    and length into the source, a line number and, for identifiers, a
+    symbol ID from the stream's Interner: 21 bytes instead of a Token
+    object and its lexeme string. Indexing returns a TokenView, so a
+    TokenStream can be handed to the Parser in place of a list of tokens.
+    """
+
+    def __init__(self, source, interner=SYMBOLS):
+        self.source = source
+        self.interner = interner
+        self.kinds = array("B")
+        self.starts = array("Q")
+        self.lengths = array("I")
+        self.lines = array("I")
+        self.symbols = array("I")  # 0 for anything but an identifier
+        # The parser keeps the view of its current token, so the one it most
+        # often asks for again is the last one built, after looking ahead
+        self.view_index = None
+        self.view = None
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        if index == self.view_index:
+            return self.view
+        kind = self.kinds[index]
+        start = self.starts[index]
+        symbol = self.symbols[index] if kind == KIND_IDENTIFIER else None
+        view = TokenView(KIND_TYPES[kind], self.lines[index], KIND_LEXEMES[kind], symbol,
+                         self.source, start, start + self.lengths[index])
+        self.view_index = index
+        self.view = view
+        return view
+
+    def __iter__(self):
+        for index in range(len(self.kinds)):
+            yield self[index]
+
+    def tokens(self):
+        """The same tokens as a list of Token objects."""
+        source = self.source
+        return [Token(KIND_TYPES[kind], KIND_LEXEMES[kind] or source[start:start + length], line_number,
+                      symbol if kind == KIND_IDENTIFIER else None)
+                for kind, start, length, line_number, symbol
+                in zip(self.kinds, self.starts, self.lengths, self.lines, self.symbols)]
+
+
+def scanTokens(source, pos, line_number, stream, final=True, limit=None):
+    """Lex source[pos:] and add the tokens found to a TokenStream over source.
+
+    With final=False the source is only a prefix of the input, so scanning
+    stops before any lexeme that could continue past the end of it, and
+    before a comment whose closer has not been seen yet.  Scanning also
+    stops after limit tokens if one is given.  Returns (pos, line_number,
+    closer) where pos is where scanning stopped and closer is the pending
+    comment closer, if that is why it stopped.
+    """
+    add_kind = stream.kinds.append
+    add_start = stream.starts.append
+    add_length = stream.lengths.append
+    add_line = stream.lines.append
+    add_symbol = stream.symbols.append
+    intern = stream.interner.intern
     length = len(source)
-    line_number = 1
-   
-    keywords = ["if", "else", "endif", "while", "endwhile", "for",
-               "function", "return", "integer", "boolean",
-               "print", "scan", "true", "false"]
-    operators = ["==", "!=", "<=", "=>", "+", "-", "*", "/", "=", "<", ">"]
-    separators = [",", ";", "(", ")", "{", "}", "$$"]
-   
-    while i < length:
-        # Track line numbers for better error reporting
-        if source[i] == '\n':
-            line_number += 1
-            i += 1
-            continue
-           
-        if source[i].isspace():
-            i += 1
-            continue
+    # Counts down to 0 after limit tokens; with no limit it never gets there
+    remaining = limit if limit is not None else -1
+    lexeme_kinds = LEXEME_KINDS
+    count = source.count
+
+    while True:
+        for match in LEXEME.finditer(source, pos):
+            group = match.lastgroup
+            pos, end = match.span()
+
+            if group == "space":
+                line_number += count("\n", pos, end)
+                continue
+
+            if group == "word":
+                if end == length and not final:
+                    return pos, line_number, None
+                # Keywords are case-insensitive and are checked before the identifier rule
+                token_kind = lexeme_kinds.get(match.group().lower(), KIND_IDENTIFIER)
 
+            elif group == "separator" or group == "operator":
+                if group == "operator" and end - pos == 1 and end == length and not final:
+                    return pos, line_number, None   # may be the first half of a two-character operator
+                token_kind = lexeme_kinds[match.group()]
 
+            elif group == "integer":
+                if end == length and not final:
+                    return pos, line_number, None
+                token_kind = KIND_INTEGER
 
+            elif group == "comment":
+                line_number += count("\n", pos, end)
+                continue
+
+            elif group == "unclosed":
+                closer = COMMENT_CLOSERS[match.group()]
+                if not final:
+                    return pos, line_number, closer
+                # Resume lexing at the final character, as the original scanner did
+                end = max(end, length - 1)
+                print(f"Warning: Unclosed comment starting at line {line_number}")
+                line_number += count("\n", pos, end)
+                pos = end
+                break
 
-        # Look for comments - we don't tokenize these, just skip over them
-        if i + 1 < length and source[i:i+2] == "/*":
-            comment_start_line = line_number  # Track starting line for error reporting
-            i += 2
-            while i + 1 < length and source[i:i+2] != "*/":
-                if source[i] == '\n':
-                    line_number += 1
-                i += 1
-           
-            if i + 1 < length:
-                i += 2  # Skip over the */
             else:
-                # Report unclosed comment but don't add to tokens
+                # Any other run of characters up to the next delimiter
+                if end == length and not final:
+                    return pos, line_number, None
+                char = source[pos]
+                kind = CHAR_CLASS.get(char)
+                if kind is None:
+                    kind = classifyChar(char)
+                if kind == CH_ALPHA:
+                    token_kind = None
+                    if end - pos <= KEYWORD_MAX_LENGTH:
+                        lowered = source[pos:end].lower()
+                        if lowered in KEYWORDS:
+                            token_kind = lexeme_kinds[lowered]
+                    if token_kind is None:
+                        token_kind = KIND_IDENTIFIER if IDENTIFIER.fullmatch(source, pos, end) else KIND_ERROR
+                elif kind == CH_DIGIT:
+                    # Reals are not part of the language, so anything but digits is an error
+                    token_kind = KIND_INTEGER if source[pos:end].isdigit() else KIND_ERROR
+                elif kind == CH_DOT:
+                    # Handle invalid reals beginning with .
+                    token_kind = KIND_ERROR
+                else:
+                    # If no known token type is found, mark it as an invalid token
+                    # and report it, but still include it for error reporting
+                    print(f"Invalid token '{source[pos:end]}' at line {line_number}")
+                    token_kind = KIND_INVALID
+
+            add_kind(token_kind)
+            add_start(pos)
+            add_length(end - pos)
+            add_line(line_number)
+            add_symbol(intern(source[pos:end]) if token_kind == KIND_IDENTIFIER else 0)
+            remaining -= 1
+            if not remaining:
+                return end, line_number, None
+        else:
+            return length, line_number, None
+
+
+def lex_stream(source, interner=SYMBOLS):
+    """Lex a whole source string into a TokenStream, interning identifiers in interner."""
+    stream = TokenStream(source, interner)
+    scanTokens(source, 0, 1, stream)
+    return stream
+
+
+def lexer(source):
+    return lex_stream(source).tokens()
+
+
+def relex(stream, edits):
+    """Apply edits to the source of a TokenStream and return a TokenStream over the result.
+
+    edits is a list of (start, end, replacement) tuples in old source
+    offsets, which must not overlap.  Only the tokens around the edits are
+    lexed again: scanning restarts after the last token that cannot have
+    been affected by the first edit (a lexeme ends at a delimiter or at
+    $$, so a token depends on at most the two characters after it), and stops at the first new token that
+    starts where an old token started once past the last edit, since
+    from there on the source, and so the tokens, are the same as before.
+    The old tokens after that point are reused with their offsets and
+    line numbers shifted.  A comment opened or closed by an edit needs no
+    special care; scanning simply carries on past whatever it swallows or
+    exposes until the streams line up again.
+    """
+    source = stream.source
+    if not isinstance(source, str):
+        raise TypeError("relex() needs a TokenStream over a str source")
+    edits = sorted(edits)
+    if not edits:
+        return stream
+
+    pieces = []
+    copied = 0
+    delta = 0
+    for start, end, replacement in edits:
+        if start < copied or end < start or end > len(source):
+            raise ValueError(f"Bad or overlapping edit ({start}, {end})")
+        pieces.append(source[copied:start])
+        pieces.append(replacement)
+        copied = end
+        delta += len(replacement) - (end - start)
+    pieces.append(source[copied:])
+    new_source = "".join(pieces)
+    first_edit = edits[0][0]
+    last_edit = edits[-1][1]  # Old offset where the unchanged tail begins
+
+    starts = stream.starts
+    lengths = stream.lengths
+    # Keep every token whose end, and the two characters after it, come before the first edit
+    kept = bisect_left(starts, first_edit)
+    while kept and starts[kept - 1] + lengths[kept - 1] + 1 >= first_edit:
+        kept -= 1
+    if kept:
+        pos = starts[kept - 1] + lengths[kept - 1]
+        line_number = stream.lines[kept - 1]
+    else:
+        pos = 0
+        line_number = 1
+
+    result = TokenStream(new_source, stream.interner)
+    for old, new in ((stream.kinds, result.kinds), (starts, result.starts), (lengths, result.lengths),
+                     (stream.lines, result.lines), (stream.symbols, result.symbols)):
+        new.extend(old[:kept])
+
+    # Lex one token at a time until a token lines up with the old stream
+    resync = None
+    next_old = bisect_left(starts, last_edit)
+    while pos < len(new_source):
+        count = len(result)
+        pos, line_number, _ = scanTokens(new_source, pos, line_number, result, limit=1)
+        if len(result) == count:
+            break   # Nothing but whitespace and comments left
+        old_start = result.starts[-1] - delta
+        while next_old < len(starts) and starts[next_old] < old_start:
+            next_old += 1
+        if next_old < len(starts) and starts[next_old] == old_start:
+            resync = next_old
+            break
+
+    if resync is not None:
+        # Replace the token that lined up with the old one and everything after it
+        line_delta = result.lines[-1] - stream.lines[resync]
+        for column in (result.kinds, result.starts, result.lengths, result.lines, result.symbols):
+            column.pop()
+        result.kinds.extend(stream.kinds[resync:])
+        result.starts.extend(array("Q", [start + delta for start in starts[resync:]]))
+        result.lengths.extend(lengths[resync:])
+        result.lines.extend(array("I", [line + line_delta for line in stream.lines[resync:]]))
+        result.symbols.extend(stream.symbols[resync:])
+    return result
+
+
+def iter_tokens(stream, chunk_size=CHUNK_SIZE):
+    """Lex a text stream chunk by chunk, yielding the same tokens as lexer().
+
+    Only the unfinished lexeme at the end of each chunk is carried over, and
+    comments are skipped as they stream past, so the lexer's own memory use
+    does not depend on the length of the input.  What the parser builds
+    from the tokens still does.
+    """
+    pending = ""
+    line_number = 1
+    closer = None
+    comment_start_line = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        final = not chunk
+        pending += chunk
+
+        if closer is not None:
+            close = pending.find(closer)
+            if close < 0 and not final:
+                # Keep the last character in case it starts the closer
+                line_number += pending.count("\n", 0, len(pending) - 1)
+                pending = pending[-1:]
+                continue
+            if close < 0:
+                end = max(0, len(pending) - 1)
+                line_number += pending.count("\n", 0, end)
                 print(f"Warning: Unclosed comment starting at line {comment_start_line}")
-            continue
-           
-        # Check for [* *] style comments - skip over these too
-        if i + 1 < length and source[i:i+2] == "[*":
-            comment_start_line = line_number
-            i += 2
-            while i + 1 < length and source[i:i+2] != "*]":
-                if source[i] == '\n':
-                    line_number += 1
-                i += 1
-           
-            if i + 1 < length:
-                i += 2  # Skip over the *]
+                pending = pending[end:]
             else:
-                # Report unclosed comment but don't add to tokens
-                print(f"Warning: Unclosed comment starting at line {comment_start_line}")
+                line_number += pending.count("\n", 0, close)
+                pending = pending[close + 2:]
+            closer = None
+
+        tokens = TokenStream(pending)
+        pos, line_number, closer = scanTokens(pending, 0, line_number, tokens, final)
+        yield from tokens
+        if closer is not None:
+            comment_start_line = line_number
+            pos += 2
+        pending = pending[pos:]
+        if final and closer is None:
+            return
+
+
+def scanMappedTokens(buffer, pos, line_number, stream, limit=None):
+    """Lex an ASCII bytes-like buffer in place into a TokenStream over it.
+
+    Produces the same tokens as lexer() on the file read in text mode,
+    including its newline translation.  Stops after about limit tokens if
+    one is given and returns (pos, line_number) to resume from.
+    """
+    add_kind = stream.kinds.append
+    add_start = stream.starts.append
+    add_length = stream.lengths.append
+    add_line = stream.lines.append
+    add_symbol = stream.symbols.append
+    intern = stream.interner.intern_bytes
+    length = len(buffer)
+    stop = len(stream.kinds) + limit if limit is not None else None
+    byte_class = BYTE_CLASS
+    lexeme_kinds = BYTE_LEXEME_KINDS
+    run_end = BYTE_LEXEME_RUN.match
+
+    while pos < length:
+        kind = byte_class[buffer[pos]]
+
+        # Skip whitespace in bulk; \r\n and a lone \r are one newline each
+        if kind <= CH_SPACE:
+            end = BYTE_WHITESPACE_RUN.match(buffer, pos).end()
+            if kind == CH_NEWLINE or end - pos > 1:
+                line_number += len(BYTE_NEWLINE.findall(buffer, pos, end))
+            pos = end
             continue
 
+        if kind == CH_ALPHA:
+            end = run_end(buffer, pos + 1).end()
+            token_kind = None
+            if end - pos <= KEYWORD_MAX_LENGTH:
+                token_kind = lexeme_kinds.get(buffer[pos:end].lower())
+            if token_kind is None:
+                token_kind = KIND_IDENTIFIER if BYTE_IDENTIFIER.match(buffer, pos).end() == end else KIND_ERROR
 
+        elif kind == CH_SEPARATOR:
+            end = pos + 1
+            token_kind = lexeme_kinds[buffer[pos:end]]
 
+        elif kind == CH_DIGIT:
+            end = run_end(buffer, pos + 1).end()
+            token_kind = KIND_INTEGER if BYTE_DIGITS.match(buffer, pos).end() == end else KIND_ERROR
 
-        # Look for $$
-        if i + 1 < length and source[i:i+2] == "$$":
-            tokens.append(Token("separator", "$$", line_number))
-            i += 2  # Go past $$
-            continue
+        else:
+            pair = buffer[pos:pos + 2]
+            token_kind = None
+            if kind == CH_OPENER:
+                closer = BYTE_COMMENT_CLOSERS.get(pair)
+                if closer is not None:
+                    comment_start_line = line_number
+                    close = buffer.find(closer, pos + 2)
+                    if close >= 0:
+                        end = close + 2
+                        line_number += len(BYTE_NEWLINE.findall(buffer, pos + 2, close))
+                    else:
+                        # Resume at the final character of the translated text
+                        end = max(pos + 2, length - 1)
+                        if end > pos + 2 and buffer[end - 1:end + 1] == b"\r\n":
+                            end -= 1
+                        line_number += len(BYTE_NEWLINE.findall(buffer, pos + 2, end))
+                        print(f"Warning: Unclosed comment starting at line {comment_start_line}")
+                    pos = end
+                    continue
+                if pair == b"$$":
+                    end = pos + 2
+                    token_kind = lexeme_kinds[pair]
+                elif pair[:1] == b"/":
+                    end = pos + 1
+                    token_kind = lexeme_kinds[b"/"]
+            elif kind == CH_OPERATOR:
+                token_kind = lexeme_kinds.get(pair)
+                if token_kind is not None:
+                    end = pos + 2
+                else:
+                    token_kind = lexeme_kinds.get(pair[:1])
+                    end = pos + 1
+
+            if token_kind is None:
+                end = run_end(buffer, pos + 1).end()
+                if kind == CH_DOT:
+                    token_kind = KIND_ERROR
+                else:
+                    lexeme = buffer[pos:end].decode("ascii")
+                    print(f"Invalid token '{lexeme}' at line {line_number}")
+                    token_kind = KIND_INVALID
+
+        add_kind(token_kind)
+        add_start(pos)
+        add_length(end - pos)
+        add_line(line_number)
+        add_symbol(intern(buffer[pos:end]) if token_kind == KIND_IDENTIFIER else 0)
+        pos = end
+        if len(stream.kinds) == stop:
+            break
+
+    return pos, line_number
+
+
+def lex_mapped(buffer):
+    """Lex a bytes-like buffer (typically an mmap of the input file) into a TokenStream.
+
+    Lexemes stay in the buffer until they are read.  Input with non-ASCII
+    bytes is decoded first, since the byte tables only match the str
+    predicates the language rules use for ASCII.
+    """
+    if NON_ASCII.search(buffer):
+        return lex_stream(decodeText(buffer))
+    stream = TokenStream(buffer)
+    scanMappedTokens(buffer, 0, 1, stream)
+    return stream
+
+
+def iter_mapped_tokens(buffer, batch_size=BATCH_SIZE):
+    """Like lex_mapped(), but lexes the buffer in batches as tokens are pulled."""
+    if NON_ASCII.search(buffer):
+        yield from lex_stream(decodeText(buffer))
+        return
+    pos = 0
+    line_number = 1
+    while pos < len(buffer):
+        stream = TokenStream(buffer)
+        pos, line_number = scanMappedTokens(buffer, pos, line_number, stream, batch_size)
+        yield from stream
+
+
+def decodeText(buffer):
+    """Decode a buffer the way reading the file in text mode would."""
+    return bytes(buffer).decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+class TokenWindow:
+    """Bounded ring buffer of tokens pulled on demand from a token iterator.
+
+    Tokens are addressed by their absolute position in the stream, so the
+    parser keeps using plain indexes.  Tokens before the floor set by the
+    parser are dropped as new ones arrive; the ring only grows if the
+    parser looks further ahead than it holds.
+    """
+
+    def __init__(self, token_iter, capacity=WINDOW_SIZE):
+        self.source = token_iter
+        self.ring = [None] * capacity
+        self.capacity = capacity
+        self.start = 0      # absolute index of the oldest buffered token
+        self.end = 0        # absolute index one past the newest buffered token
+        self.floor = 0      # tokens before this may be dropped
+        self.exhausted = False
+
+    def __getitem__(self, index):
+        if index < self.start:
+            raise RuntimeError(f"Token {index} is no longer in the lookahead window")
+        while index >= self.end:
+            if self.exhausted:
+                raise IndexError(index)
+            token = next(self.source, None)
+            if token is None:
+                self.exhausted = True
+                raise IndexError(index)
+            self.push(token)
+        return self.ring[index % len(self.ring)]
+
+    def push(self, token):
+        ring = self.ring
+        size = len(ring)
+        if self.end - self.start == size:
+            if self.start < self.floor:
+                self.start += 1  # the oldest slot is reused below
+            else:
+                grown = [None] * (size * 2)
+                for index in range(self.start, self.end):
+                    grown[index % len(grown)] = ring[index % size]
+                self.ring = ring = grown
+                size = len(ring)
+        ring[self.end % size] = token
+        self.end += 1
+
+
+class SectionCache:
+    """Parsed $$ sections, keyed by section fingerprint.
+
+    A fingerprint covers the tokens of the section and everything the
+    parser can see from inside it, so an entry is only reused where a full
+    parse would produce exactly the same trace and syntax tree.  Entries
+    are kept in memory, and in a pickle file if a path is given, least
+    recently used first out.  The trees hold symbol IDs, so the file also
+    keeps the names of the interner they came from.
+    """
+
+    def __init__(self, path=None, size=SECTION_CACHE_SIZE, interner=SYMBOLS):
+        self.path = path
+        self.size = size
+        self.interner = interner
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    data = pickle.load(f)
+                if isinstance(data, dict) and data.get("version") == SECTION_CACHE_VERSION:
+                    self.adopt(data["names"], data["entries"])
+            except Exception as e:
+                print(f"Ignoring unreadable section cache {path}: {e}")
 
+    def adopt(self, names, entries):
+        """Take on saved entries if their symbol IDs mean the same here."""
+        known = self.interner.names
+        shared = min(len(known), len(names))
+        if known[:shared] != names[:shared]:
+            return
+        for name in names[shared:]:
+            self.interner.intern(name)
+        self.entries = entries
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        while len(self.entries) > self.size:
+            del self.entries[next(iter(self.entries))]
 
+    def save(self):
+        if self.path is None:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump({"version": SECTION_CACHE_VERSION,
+                         "names": self.interner.names,
+                         "entries": self.entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path)
 
 
+class SymbolTable:
+    """Global variables by symbol ID, in declaration order.
 
+    Each entry is the (type, memory address, declaring line) of a global,
+    so a reference resolves with a single lookup.  Addresses are handed
+    out one word apart from the base as variables are declared.
+    """
 
+    def __init__(self, base=MEMORY_BASE):
+        self.base = base
+        self.entries = {}
 
+    def __len__(self):
+        return len(self.entries)
 
-        # Handle identifiers (keywords and variable names)
-        if source[i].isalpha():
-            isError = False
-            start = i
-            i += 1  # Move past the first character that we already checked
-            while (i < length and
-                   source[i] not in [" ", "\n", "(", ")", "{", "}", ";", ","] and
-                   not (i + 1 < length and source[i:i+2] == "$$")):
-                i += 1
-            lexeme = source[start:i]
-           
-            # First check if it's a keyword (before checking for valid identifier characters)
-            if lexeme.lower() in keywords:  # Case-insensitive keywords
-                tokens.append(Token("keyword", lexeme.lower(), line_number))
-            # Then check if it's a valid identifier
-            elif all(c.isalnum() or c == "_" for c in lexeme):
-                tokens.append(Token("identifier", lexeme, line_number))
-            # Otherwise, it's an error
-            else:
-                tokens.append(Token("error", lexeme, line_number))
-            continue
+    def __contains__(self, symbol):
+        return symbol in self.entries
 
+    def declare(self, symbol, var_type, line):
+        """Add a global and return its address, or None if it is already declared."""
+        if symbol in self.entries:
+            return None
+        address = self.base + len(self.entries)
+        self.entries[symbol] = (var_type, address, line)
+        return address
 
+    def type(self, symbol):
+        entry = self.entries.get(symbol)
+        return entry[0] if entry is not None else None
 
+    def address(self, symbol):
+        entry = self.entries.get(symbol)
+        return entry[1] if entry is not None else None
 
+    def items(self):
+        return self.entries.items()
 
 
+class Scopes:
+    """Nested local scopes, flattened into one map of binding stacks.
 
+    Every symbol declared in an open scope has a stack of (type, depth)
+    bindings, innermost last, so a lookup is a single probe however deep
+    the nesting.  Entering a scope only counts the depth; the list of what
+    a scope declared, which exit() undoes, is made on its first declaration.
+    """
 
-        # Handle invalid reals beginning with .
-        if source[i] == '.':
-            start = i
-            i += 1
-            while (i < length and
-                   source[i] not in [" ", "\n", "(", ")", "{", "}", ";", ","] and
-                   not (i + 1 < length and source[i:i+2] == "$$")):
-                i += 1
-            lexeme = source[start:i]
-            tokens.append(Token("error", lexeme, line_number))
-            continue
+    def __init__(self):
+        self.bindings = {}  # Symbol ID -> [(type, depth), ...]
+        self.declared = {}  # Depth -> symbols declared at that depth
+        self.depth = 0
 
+    def enter(self):
+        self.depth += 1
 
+    def exit(self):
+        if not self.depth:
+            return
+        for symbol in self.declared.pop(self.depth, ()):
+            stack = self.bindings[symbol]
+            stack.pop()
+            if not stack:
+                del self.bindings[symbol]
+        self.depth -= 1
+
+    def declare(self, symbol, var_type):
+        """Bind symbol in the innermost scope; False if it is already bound there."""
+        stack = self.bindings.get(symbol)
+        if stack is None:
+            stack = self.bindings[symbol] = []
+        elif stack[-1][1] == self.depth:
+            return False
+        stack.append((var_type, self.depth))
+        declared = self.declared.get(self.depth)
+        if declared is None:
+            declared = self.declared[self.depth] = []
+        declared.append(symbol)
+        return True
+
+    def type(self, symbol):
+        """Type of the innermost binding of symbol, or None if it has none."""
+        stack = self.bindings.get(symbol)
+        return stack[-1][0] if stack else None
+
+
+# Instructions of the target machine, by opcode.  The first OPERAND_OPCODES
+# list an operand; a LABEL's operand is the label it places, which jumps to
+# it refer to until the code is linked.
+OPCODES = ["PUSHI", "PUSHM", "POPM", "JMP0", "JMP",
+           "SOUT", "SIN", "A", "S", "M", "D", "GRT", "LES", "EQU", "NEQ", "GEQ", "LEQ", "LABEL"]
+OPERAND_OPCODES = 5
+(OP_PUSHI, OP_PUSHM, OP_POPM, OP_JMP0, OP_JMP,
+ OP_SOUT, OP_SIN, OP_A, OP_S, OP_M, OP_D, OP_GRT, OP_LES, OP_EQU, OP_NEQ, OP_GEQ, OP_LEQ, OP_LABEL) = range(len(OPCODES))
+RELOP_OPCODES = {"==": OP_EQU, "!=": OP_NEQ, ">": OP_GRT, "<": OP_LES, "<=": OP_LEQ, "=>": OP_GEQ}
+ARITHMETIC_OPCODES = {"+": OP_A, "-": OP_S, "*": OP_M, "/": OP_D}
+
+
+def arithmetic(opcode, left, right):
+    """What A, S, M or D leave on the stack for left and right; D truncates toward zero."""
+    if opcode == OP_A:
+        return left + right
+    if opcode == OP_S:
+        return left - right
+    if opcode == OP_M:
+        return left * right
+    quotient = abs(left) // abs(right)
+    return quotient if (left < 0) == (right < 0) else -quotient
+
+
+def comparison(opcode, left, right):
+    """Whether a GRT, LES, EQU, NEQ, GEQ or LEQ of left and right holds."""
+    if opcode == OP_GRT:
+        return left > right
+    if opcode == OP_LES:
+        return left < right
+    if opcode == OP_EQU:
+        return left == right
+    if opcode == OP_NEQ:
+        return left != right
+    if opcode == OP_GEQ:
+        return left >= right
+    return left <= right
+
+
+def operand_value(text):
+    """The value of integer text if it fits a 64-bit operand, else None.
+
+    Text with more digits than that is never converted, as CPython refuses
+    to convert more than a few thousand.
+    """
+    if len(text.lstrip("-0")) > 19:
+        return None
+    value = int(text)
+    return value if -(1 << 63) <= value < 1 << 63 else None
+
+
+class CodeBuffer:
+    """Generated code as parallel arrays: an opcode byte and an operand per instruction.
+
+    Jumps target labels, numbered by label(), until link() replaces them
+    with the instruction numbers the labels ended up at.  Instructions are
+    only turned into listing text by listing().  An operand whose text is
+    not its plain value - a literal with leading zeros, or one too big for
+    the operand array - keeps its text in texts, by instruction index, and
+    its operand is 0.
+    """
+
+    def __init__(self):
+        self.opcodes = bytearray()
+        self.operands = array("q")
+        self.texts = {}
+        self.labels = 0
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def emit(self, opcode, operand=0):
+        """Append an instruction and return its index."""
+        self.opcodes.append(opcode)
+        self.operands.append(operand)
+        return len(self.opcodes) - 1
+
+    def emitLiteral(self, text):
+        """Append a PUSHI of an integer literal, keeping its text if the value would not print as it."""
+        value = operand_value(text)
+        if value is not None and str(value) == text:
+            return self.emit(OP_PUSHI, value)
+        index = self.emit(OP_PUSHI)
+        self.texts[index] = text
+        return index
+
+    def emitValue(self, value):
+        """Append a PUSHI of a value worked out while compiling."""
+        return self.emitLiteral(str(value))
+
+    def constant(self, start, end=None):
+        """The value pushed if the code from start to end is a single PUSHI of a value that fits an operand, else None."""
+        if end is None:
+            end = len(self.opcodes)
+        if end != start + 1 or self.opcodes[start] != OP_PUSHI:
+            return None
+        text = self.texts.get(start)
+        return operand_value(text) if text is not None else self.operands[start]
+
+    def truncate(self, length):
+        """Drop the instructions from length on."""
+        del self.opcodes[length:]
+        del self.operands[length:]
+        for index in [index for index in self.texts if index >= length]:
+            del self.texts[index]
+
+    def label(self):
+        """A new label, for jumps to refer to before it is placed."""
+        self.labels += 1
+        return self.labels - 1
+
+    def place(self, label):
+        """Append the LABEL instruction for label."""
+        return self.emit(OP_LABEL, label)
+
+    def link(self):
+        """Point every jump at the number of the instruction its label is placed at."""
+        addresses = array("q", bytes(8 * self.labels))
+        jumps = []
+        operands = self.operands
+        for index, opcode in enumerate(self.opcodes):
+            if opcode == OP_LABEL:
+                addresses[operands[index]] = index + 1
+            elif opcode == OP_JMP0 or opcode == OP_JMP:
+                jumps.append(index)
+        for index in jumps:
+            operands[index] = addresses[operands[index]]
+
+    def instruction(self, index):
+        """Listing text of one instruction."""
+        opcode = self.opcodes[index]
+        if opcode >= OPERAND_OPCODES:
+            return OPCODES[opcode]
+        operand = self.texts.get(index)
+        if operand is None:
+            operand = self.operands[index]
+        return f"{OPCODES[opcode]:<10}{operand}"
+
+    def listing(self):
+        # What instruction() gives for each index, without a call per instruction
+        texts = self.texts
+        for index, (opcode, operand) in enumerate(zip(self.opcodes, self.operands)):
+            if opcode >= OPERAND_OPCODES:
+                yield OPCODES[opcode]
+            else:
+                text = texts.get(index)
+                yield f"{OPCODES[opcode]:<10}{operand if text is None else text}"
+
+    def instructions(self):
+        """The code as a list of (opcode, operand, operand text or None)."""
+        texts = self.texts
+        return [(opcode, operand, texts.get(index))
+                for index, (opcode, operand) in enumerate(zip(self.opcodes, self.operands))]
+
+    def rewrite(self, instructions):
+        """Replace the code with a list like the one instructions() returns."""
+        self.opcodes = bytearray(instruction[0] for instruction in instructions)
+        self.operands = array("q", [instruction[1] for instruction in instructions])
+        self.texts = {index: instruction[2] for index, instruction in enumerate(instructions)
+                      if instruction[2] is not None}
+
+
+# Peephole optimization (-O1) - rewrites unlinked code, whose jumps still
+# name labels, so instructions can come and go without breaking any target.
+# Each round drops the code no path reaches, then applies the rules.  A rule
+# is (opcode pattern, rewrite): where the next instructions have the opcodes
+# in the pattern, None matching any, rewrite(labels, *instructions) returns
+# what to put in their place, or None to leave them.
+class LabelInfo:
+    """What a peephole pass knows of the labels in the code it starts on.
+
+    Labels placed next to each other are the same place, so each has a
+    canonical label: the first of its run that a jump refers to.  after
+    holds the first instruction after each run.  Jumps only ever move to a
+    label that already had one, and labels that had none are the only ones
+    dropped, so the counts can go stale during the pass without harm.
+    """
+
+    def __init__(self, instructions):
+        self.references = {}
+        for opcode, operand, _ in instructions:
+            if opcode == OP_JMP0 or opcode == OP_JMP:
+                self.references[operand] = self.references.get(operand, 0) + 1
+        self.canonical = {}
+        self.after = {}
+        run = []
+        for instruction in instructions + [None]:
+            if instruction is not None and instruction[0] == OP_LABEL:
+                run.append(instruction[1])
+                continue
+            if run:
+                canonical = next((label for label in run if label in self.references), run[0])
+                for label in run:
+                    self.canonical[label] = canonical
+                    self.after[label] = instruction
+                run = []
+
+    def target(self, label):
+        """Where a jump to label can go instead: past the labels and unconditional jumps it lands on."""
+        seen = {label}
+        target = self.canonical.get(label, label)
+        while True:
+            following = self.after.get(target)
+            if following is None or following[0] != OP_JMP:
+                return target
+            target = self.canonical.get(following[1], following[1])
+            if target in seen:
+                # A loop of jumps - leave it as it is
+                return label
+            seen.add(target)
+
+
+def dropLoadStore(labels, load, store):
+    # PUSHM a; POPM a stores back the value just loaded
+    return [] if load[1] == store[1] else None
+
+
+def dropUnusedLabel(labels, label):
+    return [] if label[1] not in labels.references else None
+
+
+def threadJump(labels, jump):
+    # A jump to a label next to others, or to a JMP, can go straight to where it ends up
+    target = labels.target(jump[1])
+    if target == jump[1]:
+        return None
+    labels.references[target] = labels.references.get(target, 0) + 1
+    return [(jump[0], target, None)]
 
 
-        # Handle numbers (integers and real numbers)
-        if source[i].isdigit():
-            isError = False
-            start = i
-            i += 1  # Move past the first digit that we already checked
-            while (i < length and
-                   source[i] not in [" ", "\n", "(", ")", "{", "}", ";", ","] and
-                   not (i + 1 < length and source[i:i+2] == "$$")):
-                if not source[i].isdigit() and source[i] != '.':
-                    isError = True    
-                i += 1
-            lexeme = source[start:i]
-            if lexeme.count(".") > 1:
-                tokens.append(Token("error", lexeme, line_number))
-            elif '.' in lexeme and lexeme.count(".") == 1:
-                sides = lexeme.split('.')
-                if sides[0].isdigit() and sides[1].isdigit():
-                    tokens.append(Token("error", lexeme, line_number))
-                else:
-                    tokens.append(Token("error", lexeme, line_number))
+def dropJumpToNext(labels, jump, label):
+    if labels.canonical.get(jump[1], jump[1]) != labels.canonical.get(label[1]):
+        return None
+    return [label]
+
+
+def reachable(instructions):
+    """The instructions that some path from the first one gets to."""
+    places = {operand: index for index, (opcode, operand, _) in enumerate(instructions) if opcode == OP_LABEL}
+    reached = bytearray(len(instructions))
+    pending = [0] if instructions else []
+    while pending:
+        index = pending.pop()
+        # Run straight on from index until an unconditional jump or code already reached
+        while index < len(instructions) and not reached[index]:
+            reached[index] = 1
+            opcode, operand, _ = instructions[index]
+            if opcode == OP_JMP0 or opcode == OP_JMP:
+                target = places.get(operand)
+                if target is not None:
+                    pending.append(target)
+                if opcode == OP_JMP:
+                    break
+            index += 1
+    return [instruction for instruction, live in zip(instructions, reached) if live]
+
+
+PEEPHOLE_RULES = [
+    ((OP_PUSHM, OP_POPM), dropLoadStore),
+    ((OP_LABEL,), dropUnusedLabel),
+    ((OP_JMP, OP_LABEL), dropJumpToNext),
+    ((OP_JMP,), threadJump),
+    ((OP_JMP0,), threadJump),
+]
+
+
+def peephole(code, rules=PEEPHOLE_RULES):
+    """Apply rules to code until none of them changes it; return how many instructions went."""
+    instructions = code.instructions()
+    start = len(instructions)
+    by_opcode = {}
+    for rule in rules:
+        by_opcode.setdefault(rule[0][0], []).append(rule)
+    # After a rewrite, this many instructions before it are looked at again
+    back = max((len(pattern) for pattern, _ in rules), default=1) - 1
+    changed = True
+    while changed:
+        # Code no path reaches goes first, with any labels only it jumps to
+        live = reachable(instructions)
+        changed = len(live) != len(instructions)
+        instructions = live
+        labels = LabelInfo(instructions)
+        # Instructions still to look at, next one last, so a rewrite can push its result back
+        pending = instructions[::-1]
+        instructions = []
+        while pending:
+            for pattern, rewrite in by_opcode.get(pending[-1][0], ()):
+                size = len(pattern)
+                if size > len(pending):
+                    continue
+                window = pending[:-size - 1:-1]
+                if any(opcode is not None and opcode != instruction[0]
+                       for opcode, instruction in zip(pattern, window)):
+                    continue
+                replacement = rewrite(labels, *window)
+                if replacement is not None:
+                    del pending[-size:]
+                    pending.extend(reversed(replacement))
+                    for _ in range(min(back, len(instructions))):
+                        pending.append(instructions.pop())
+                    changed = True
+                    break
+            else:
+                instructions.append(pending.pop())
+    code.rewrite(instructions)
+    return start - len(instructions)
+
+
+# Values each opcode pops and pushes.  SIN pushes a value for each POPM
+# right after it, so its entry is left out here.
+STACK_EFFECTS = {OP_PUSHI: (0, 1), OP_PUSHM: (0, 1), OP_POPM: (1, 0), OP_JMP0: (1, 0), OP_JMP: (0, 0),
+                 OP_SOUT: (1, 0), OP_LABEL: (0, 0)}
+STACK_EFFECTS.update({opcode: (2, 1) for opcode in ARITHMETIC_OPCODES.values()})
+STACK_EFFECTS.update({opcode: (2, 1) for opcode in RELOP_OPCODES.values()})
+
+
+class CodeAnalysis:
+    """What analyze_code() found out about linked code by following every path through it.
+
+    depths holds the stack depth before each instruction a path reaches,
+    or -1 for those none does, and max_depth the deepest the stack gets.
+    addresses is the sorted list of addresses that code reached loads or
+    stores, and inputs the number of values each SIN reads, by index.
+    conflicts holds (index, depth, other depth) for each instruction that
+    paths reach with different depths; underflow is whether some path pops
+    an empty stack, and bad_jumps whether some jump leaves the code.
+    """
+
+    def __init__(self, count):
+        self.depths = array("q", [-1]) * count
+        self.max_depth = 0
+        self.addresses = []
+        self.inputs = {}
+        self.conflicts = []
+        self.underflow = False
+        self.bad_jumps = False
+
+    @property
+    def safe(self):
+        """Whether no path can take the stack below empty or past max_depth, jump out of the code, or address below memory."""
+        return (not self.conflicts and not self.underflow and not self.bad_jumps
+                and (not self.addresses or self.addresses[0] >= MEMORY_BASE))
+
+
+def analyze_code(code):
+    """Follow every path through linked code from its first instruction; return a CodeAnalysis."""
+    opcodes, operands, texts = code.opcodes, code.operands, code.texts
+    count = len(opcodes)
+    analysis = CodeAnalysis(count)
+    depths = analysis.depths
+    max_depth = 0
+    addresses = set()
+    conflicted = set()
+    pending = [(0, 0)] if count else []
+    while pending:
+        index, depth = pending.pop()
+        # Run straight on from index until an unconditional jump or code already reached
+        while index < count:
+            seen = depths[index]
+            if seen >= 0:
+                if seen != depth and index not in conflicted:
+                    conflicted.add(index)
+                    analysis.conflicts.append((index, seen, depth))
+                break
+            depths[index] = depth
+            opcode = opcodes[index]
+            if opcode == OP_SIN:
+                end = index + 1
+                while end < count and opcodes[end] == OP_POPM:
+                    end += 1
+                pops, pushes = 0, end - index - 1
+                analysis.inputs[index] = pushes
             else:
-                if isError:
-                    tokens.append(Token("error", lexeme, line_number))
+                pops, pushes = STACK_EFFECTS[opcode]
+            if depth < pops:
+                # The code stops here when it runs; later code is looked at as if it had not
+                analysis.underflow = True
+                depth = pops
+            depth += pushes - pops
+            if depth > max_depth:
+                max_depth = depth
+            if opcode == OP_PUSHM or opcode == OP_POPM:
+                text = texts.get(index)
+                addresses.add(int(text) if text is not None else operands[index])
+            elif opcode == OP_JMP0 or opcode == OP_JMP:
+                target = operands[index]
+                if 1 <= target <= count:
+                    pending.append((target - 1, depth))
                 else:
-                    tokens.append(Token("integer", lexeme, line_number))
-            continue
-       
-        # Handle single-character separators
-        if source[i] in separators and not (i + 1 < length and source[i:i+2] == "$$"):  
-            tokens.append(Token("separator", source[i], line_number))
-            i += 1
-            continue
+                    analysis.bad_jumps = True
+                if opcode == OP_JMP:
+                    break
+            index += 1
+    analysis.max_depth = max_depth
+    # Paths are followed in no particular order, so conflicts are put in code order
+    analysis.conflicts.sort()
+    analysis.addresses = sorted(addresses)
+    return analysis
 
 
+# Syntax tree - built by the Parser, then checked and compiled in separate passes.
+# A site is the (line, trace position) a check on the node reports an error at.
+# Lines and trace positions are relative to the node's $$ section, so a parsed
+# section can be reused anywhere; the passes keep what they find to themselves.
+class Node:
+    __slots__ = ()
 
 
-        # Handle operators (check multi-character first)
-        if i + 1 < length and source[i:i+2] in operators:
-            tokens.append(Token("operator", source[i:i+2], line_number))
-            i += 2
-            continue
-        if source[i] in operators:
-            tokens.append(Token("operator", source[i], line_number))
-            i += 1
-            continue
+class Program(Node):
+    __slots__ = ("sections",)
+
+    def __init__(self, sections):
+        self.sections = sections
+
+
+class Section(Node):
+    """Statements between two $$, with the absolute line and trace position they start at."""
+    __slots__ = ("statements", "line", "mark")
+
+    def __init__(self, statements, line, mark):
+        self.statements = statements
+        self.line = line
+        self.mark = mark
+
+
+class Declaration(Node):
+    __slots__ = ("var_type", "names")
+
+    def __init__(self, var_type, names):
+        self.var_type = var_type
+        self.names = names  # (symbol, site) of each declared identifier
+
+
+class Parameter(Node):
+    __slots__ = ("symbol", "name", "var_type", "site")
+
+    def __init__(self, symbol, name, var_type, site):
+        self.symbol = symbol
+        self.name = name
+        self.var_type = var_type
+        self.site = site
+
+
+class Function(Node):
+    __slots__ = ("symbol", "name", "site", "params", "body")
+
+    def __init__(self, symbol, name, site, params=None, body=None):
+        self.symbol = symbol
+        self.name = name
+        self.site = site
+        self.params = params  # None if the parameter list was never reached
+        self.body = body
+
+
+class Compound(Node):
+    __slots__ = ("statements",)
+
+    def __init__(self, statements):
+        self.statements = statements
 
 
+class Assign(Node):
+    __slots__ = ("symbol", "name", "site", "expression", "check")
 
+    def __init__(self, symbol, name, site, expression=None, check=None):
+        self.symbol = symbol
+        self.name = name
+        self.site = site
+        self.expression = expression  # None if there was no =
+        self.check = check
 
-       
-        # If no known token type is found, mark it as an invalid token
-        # and report it, but still include it for error reporting
+
+class If(Node):
+    __slots__ = ("condition", "complete", "then_branch", "has_else", "else_branch")
+
+    def __init__(self, condition, complete=False, then_branch=None, has_else=False, else_branch=None):
+        self.condition = condition
+        self.complete = complete  # the ) after the condition was found
+        self.then_branch = then_branch
+        self.has_else = has_else
+        self.else_branch = else_branch
+
+
+class While(Node):
+    __slots__ = ("condition", "complete", "body")
+
+    def __init__(self, condition, complete=False, body=None):
+        self.condition = condition
+        self.complete = complete
+        self.body = body if body is not None else []
+
+
+class Condition(Node):
+    __slots__ = ("left", "operator", "right", "site")
+
+    def __init__(self, left, operator, right, site):
+        self.left = left
+        self.operator = operator
+        self.right = right
+        self.site = site
+
+
+class BinOp(Node):
+    __slots__ = ("operator", "left", "right", "site")
+
+    def __init__(self, operator, left, right, site):
+        self.operator = operator
+        self.left = left
+        self.right = right
+        self.site = site
+
+
+class Factor(Node):
+    """An identifier, integer or boolean literal, or a token that is none of these."""
+    __slots__ = ("kind", "value", "symbol", "site")
+
+    def __init__(self, kind, value, symbol=None, site=None):
+        self.kind = kind  # "identifier", "integer", "boolean" or "error"
+        self.value = value
+        self.symbol = symbol
+        self.site = site
+
+
+class Call(Node):
+    __slots__ = ("symbol", "name", "site", "opened", "arguments", "tail", "check")
+
+    def __init__(self, symbol, name, site):
+        self.symbol = symbol
+        self.name = name
+        self.site = site
+        self.opened = False  # the ( after the name was found
+        self.arguments = []
+        self.tail = None   # where the argument list ended
+        self.check = None  # where the arguments were checked
+
+
+class Scan(Node):
+    __slots__ = ("targets", "complete")
+
+    def __init__(self, targets, complete=False):
+        self.targets = targets  # (symbol, name, site) of each identifier
+        self.complete = complete
+
+
+class Print(Node):
+    __slots__ = ("expression",)
+
+    def __init__(self, expression):
+        self.expression = expression
+
+
+class Return(Node):
+    __slots__ = ("expression",)
+
+    def __init__(self, expression):
+        self.expression = expression
+
+
+# Nodes the passes visit, each with an analyze and a generate method named after its class
+PASS_NODES = (Declaration, Function, Compound, Assign, If, While, Condition,
+              BinOp, Factor, Call, Scan, Print, Return)
+
+
+# Grammar productions as the trace prints them.  The parser reports a production
+# by its index here, so nothing is formatted unless an observer asks for it.
+PRODUCTIONS = []
+
+
+def production(text):
+    PRODUCTIONS.append(text)
+    return len(PRODUCTIONS) - 1
+
+
+P_PROGRAM = production("<Program> -> <Statement List>")
+P_STATEMENT_LIST = production("<Statement List> -> <Statement> <Statement List> | ε")
+P_STATEMENT = production("<Statement> -> <Compound> | <Assign> | <If> | <Return> | <Print> | <Scan> | <While> | <Declaration>")
+P_COMPOUND = production("<Compound> -> { <Statement List> }")
+P_FUNCTION = production("<Function> -> function <Identifier> ( <Parameter List> ) <Compound>")
+P_SCAN = production("<Scan> -> scan ( <IDs> );")
+P_IDS = production("<IDs> -> <Identifier> <IDsPrime>")
+P_IDS_PRIME = production("<IDsPrime> -> , <Identifier> <IDsPrime> | ε")
+P_IDS_PRIME_EMPTY = production("<IDsPrime> -> ε")
+P_PRINT = production("<Print> -> print ( <Expression> );")
+P_PARAMETER_LIST = production("<Parameter List> -> <Parameter> <Parameter List Prime> | ε")
+P_PARAMETER_LIST_EMPTY = production("<Parameter List> -> ε")
+P_PARAMETER_LIST_PRIME = production("<Parameter List Prime> -> , <Parameter> <Parameter List Prime> | ε")
+P_PARAMETER_LIST_PRIME_EMPTY = production("<Parameter List Prime> -> ε")
+P_PARAMETER = production("<Parameter> -> <IDs> <Qualifier>")
+P_QUALIFIER = production("<Qualifier> -> integer | boolean")
+P_IF = production("<If> -> if ( <Condition> ) <Statement> <IfPrime>")
+P_IF_PRIME = production("<IfPrime> -> else <Statement> endif | endif")
+P_WHILE = production("<While> -> while ( <Condition> ) <Statement List> endwhile")
+P_CONDITION = production("<Condition> -> <Expression> <Relop> <Expression>")
+P_RELOP = production("<Relop> -> == | != | > | < | <= | =>")
+P_RETURN = production("<Return> -> return <Expression> ;")
+P_ASSIGN = production("<Assign> -> <Identifier> = <Expression> ;")
+P_EXPRESSION = production("<Expression> -> <Term> <ExpressionPrime>")
+P_EXPRESSION_PRIME = production("<ExpressionPrime> -> + <Term> <ExpressionPrime> | - <Term> <ExpressionPrime> | ε")
+P_EXPRESSION_PRIME_EMPTY = production("<ExpressionPrime> -> ε")
+P_TERM = production("<Term> -> <Factor> <TermPrime>")
+P_TERM_PRIME = production("<TermPrime> -> * <Factor> <TermPrime> | / <Factor> <TermPrime> | ε")
+P_TERM_PRIME_EMPTY = production("<TermPrime> -> ε")
+P_FACTOR = production("<Factor> -> <Identifier> | <Number> | ( <Expression> ) | <Function Call>")
+P_DECLARATION = production("<Declaration> -> <Qualifier> <IDs> ;")
+P_FUNCTION_CALL = production("<Function Call> -> <Identifier> ( <Arguments> )")
+P_ARGUMENTS = production("<Arguments> -> <Expression> <ArgumentsPrime> | ε")
+P_ARGUMENTS_EMPTY = production("<Arguments> -> ε")
+P_ARGUMENTS_PRIME = production("<ArgumentsPrime> -> , <Expression> <ArgumentsPrime> | ε")
+P_ARGUMENTS_PRIME_EMPTY = production("<ArgumentsPrime> -> ε")
+
+
+# Observers - receive the parse as it happens.  An observer defines
+# on_token(token), on_production(production ID), on_error(line, message,
+# position=None) and on_warning(line, message, position).  Semantic errors
+# and warnings are only found once the whole program is parsed; they carry
+# the position, counted in events, at which the parser reached the code
+# they are about.
+class TraceObserver:
+    """Writes the parse as the text trace: a line per token, production and error."""
+
+    def __init__(self, print_productions=True):
+        self.print_productions = print_productions
+        self.output = []
+        # Events seen, and which event each line came from, when productions
+        # leave no line; otherwise each line is an event and neither is needed
+        self.events = 0
+        self.line_events = None if print_productions else array("Q")
+        self.late = []  # (position, line) of errors found after parsing
+
+    def on_token(self, token):
+        prefix = TOKEN_PREFIXES.get(token.type)
+        if prefix is None:
+            prefix = f"Token: {token.type:<15} Lexeme: "
+        self.add(prefix + token.lexeme)
+
+    def on_production(self, production_id):
+        # Productions are most of the trace, so their lines skip add()
+        if self.print_productions:
+            self.output.append(PRODUCTIONS[production_id])
         else:
-            start = i
-            i += 1  # Move past the first character
-            while (i < length and
-                   source[i] not in [" ", "\n", "(", ")", "{", "}", ";", ","] and
-                   not (i + 1 < length and source[i:i+2] == "$$")):
-                i += 1
-            lexeme = source[start:i]
-            print(f"Invalid token '{lexeme}' at line {line_number}")
-            tokens.append(Token("invalid", lexeme, line_number))
-   
-    return tokens
+            self.events += 1
+
+    def on_error(self, line, message, position=None):
+        text = f"Syntax error at line {line}: {message}"
+        if position is None:
+            self.add(text)
+        else:
+            self.late.append((position, text))
+
+    def on_warning(self, line, message, position):
+        self.late.append((position, f"Warning at line {line}: {message}"))
+
+    def add(self, text):
+        if self.line_events is not None:
+            self.line_events.append(self.events)
+        self.output.append(text)
+        self.events += 1
+
+    @property
+    def lines(self):
+        """The trace, with errors found after parsing where the parser reached their code."""
+        if self.late:
+            self.output = list(self.merge(self.output))
+            self.late = []
+            self.line_events = None if self.print_productions else array("Q")
+        return self.output
+
+    def merge(self, lines):
+        """Yield the trace lines with the errors found after parsing put in among them."""
+        late = []
+        for position, text in sorted(self.late, key=lambda error: error[0]):
+            index = position if self.line_events is None else bisect_left(self.line_events, position)
+            late.append((index, text))
+        late.reverse()
+        for number, line in enumerate(lines):
+            while late and late[-1][0] == number:
+                yield late.pop()[1]
+            yield line
+        for _, text in reversed(late):
+            yield text
+
+    def write(self, out):
+        """Write the trace to a text file, each line ended by a newline."""
+        # The trace can run to millions of lines, so it is joined and written a batch at a time
+        lines = iter(self.lines)
+        while True:
+            batch = list(islice(lines, BATCH_SIZE))
+            if not batch:
+                break
+            batch.append("")
+            out.write("\n".join(batch))
+
+
+class DiagnosticObserver:
+    """Keeps only the errors and warnings of a parse, as the trace words them, in the order it shows them."""
+
+    def __init__(self):
+        self.events = 0
+        self.found = []  # (event position, found after parsing, order found, text)
+
+    def on_token(self, token):
+        self.events += 1
+
+    def on_production(self, production_id):
+        self.events += 1
+
+    def on_error(self, line, message, position=None):
+        self.add(position, f"Syntax error at line {line}: {message}")
+
+    def on_warning(self, line, message, position):
+        self.add(position, f"Warning at line {line}: {message}")
+
+    def add(self, position, text):
+        if position is None:
+            self.found.append((self.events, 1, len(self.found), text))
+            self.events += 1
+        else:
+            # The trace puts errors found after parsing before the line at their position
+            self.found.append((position, 0, len(self.found), text))
+
+    @property
+    def lines(self):
+        return [text for _, _, _, text in sorted(self.found)]
+
+
+class TraceWriter(TraceObserver):
+    """A TraceObserver that spools a long trace to a temporary file instead of keeping it.
+
+    The first spool_lines lines stay in memory, so a short trace never
+    touches the disk.  Past that, lines are written out BATCH_SIZE at a
+    time, and lines and write() read them back CHUNK_SIZE characters at a
+    time.
+    """
+
+    def __init__(self, print_productions=True, spool_lines=SPOOL_LINES):
+        super().__init__(print_productions)
+        self.spool = None
+        self.limit = spool_lines  # Lines kept before the next write to the spool
+
+    def add(self, text):
+        if self.line_events is not None:
+            self.line_events.append(self.events)
+        self.output.append(text)
+        self.events += 1
+        # Productions are added without coming through here, so the limit can be passed
+        if len(self.output) >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile("w+", encoding="utf-8", newline="")
+            self.limit = BATCH_SIZE
+        if self.output:
+            self.output.append("")
+            self.spool.write("\n".join(self.output))
+            self.output.clear()
+
+    def read(self):
+        """Yield the spooled lines."""
+        self.spool.seek(0)
+        rest = ""
+        while True:
+            chunk = self.spool.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (rest + chunk).split("\n")
+            rest = lines.pop()
+            yield from lines
+
+    @property
+    def lines(self):
+        if self.spool is None:
+            lines = self.output
+        else:
+            self.flush()
+            lines = self.read()
+        return self.merge(lines) if self.late else lines
+
+    def write(self, out):
+        if self.spool is None or self.late:
+            super().write(out)
+            return
+        # The spool holds the trace just as it is written out, so it is copied a chunk at a time
+        self.flush()
+        self.spool.seek(0)
+        while True:
+            chunk = self.spool.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+
 
+class SectionRecorder:
+    """Records the events of a section being parsed, for the SectionCache to replay.
 
+    Productions are kept by ID, tokens as -1 - their index from the start
+    of the section, and errors as ERROR_EVENT with their relative line and
+    message alongside.
+    """
+
+    def __init__(self, parser, start):
+        self.parser = parser
+        self.start = start
+        self.events = array("l")
+        self.errors = []
+
+    def on_token(self, token):
+        self.events.append(self.start - self.parser.index - 1)
+
+    def on_production(self, production_id):
+        self.events.append(production_id)
+
+    def on_error(self, line, message, position=None):
+        self.events.append(ERROR_EVENT)
+        self.errors.append((line - self.parser.section_line, message))
 
 
 class Parser:
-    def __init__(self, tokens, print_productions=True):
+    def __init__(self, tokens, print_productions=True, window_size=WINDOW_SIZE, section_cache=None, observers=None,
+                 optimization=0):
+        # A list or TokenStream is indexed directly; any other iterable of tokens
+        # (such as iter_tokens()) is pulled through a bounded lookahead window
+        if isinstance(tokens, (list, TokenStream)):
+            self.window = None
+        else:
+            self.window = tokens = TokenWindow(iter(tokens), window_size)
         self.tokens = tokens
+        # Identifiers are looked up by the IDs the lexer gave them
+        self.symbols = tokens.interner if isinstance(tokens, TokenStream) else SYMBOLS
         self.index = 0
-        self.print_productions = print_productions
-        self.output_lines = []
+        self.token = self.tokenAt(0)  # The token at index, looked up once per move rather than on every use
+        # The text trace is kept unless other observers, or none, are given
+        if observers is None:
+            self.trace = TraceObserver(print_productions)
+            observers = [self.trace]
+        else:
+            self.trace = next((observer for observer in observers if isinstance(observer, TraceObserver)), None)
+        self.observers = list(observers)
+        self.bindObservers()
+        self.events = 0  # Tokens, productions and errors reported to observers so far
         self.error_count = 0
-        self.global_vars = {}  
-        self.scope_stack = []  # Contain dictionaries
-        self.functions = {}  # Store function names and parameters
-        self.current_line = 1 if tokens else 0
-        self.in_loop_body = False  # Track if we're parsing a loop body
-        self.in_if_body = False    # Track if we're parsing an if body
+        self.program = None
+        self.symbol_table = SymbolTable()  # Globals by symbol ID, in declaration order
+        self.scopes = Scopes()  # Local variables of the blocks being analysed
+        self.functions = {}  # Store function parameters by symbol ID
+        self.current_line = 1 if self.tokenAt(0) is not None else 0
         self.last_matched_token = None
-        self.current_var_type = None  # Track the current variable type during declarations
-        self.memAddrList = []
-        self.assemblyList = []
-
-
+        self.code = CodeBuffer()
+        self.optimization = optimization  # 1 folds constants and runs the peephole optimizer over the code
+        self.peephole_removed = 0
+        self.known = {}  # Address -> value of globals known to hold a constant at this point in the code
+        self.label_sites = {}  # Label -> (section, site, statement) of the if or while that placed it
+        self.analysis = None  # CodeAnalysis of the linked code
+        self.function_stack = []  # Functions whose bodies are being analysed, innermost last
+        self.section = None  # Section being analysed
+        self.section_line = 0  # First line and event position of the section being parsed
+        self.section_mark = 0
+        self.diagnostics = []  # (event position, line, message, is warning) of semantic errors and warnings
+        self.addresses = {}  # Node -> memory address(es) it loads or stores
+        # Pass methods by node class, looked up once rather than by name for every node
+        self.analyzers = {node_class: getattr(type(self), "analyze" + node_class.__name__) for node_class in PASS_NODES}
+        self.generators = {node_class: getattr(type(self), "generate" + node_class.__name__) for node_class in PASS_NODES}
+        # Whole $$ sections can be reused from a SectionCache when the tokens are indexable
+        self.section_cache = section_cache if self.window is None else None
+        self.section_keys = set()  # Fingerprints of the sections in this program
+        self.section_clean = True  # No exception interrupted the section being parsed
+
+
+
+
+    def tokenAt(self, index):
+        """Token at an absolute index, or None past the end of the input."""
+        if index < 0:
+            return None
+        try:
+            return self.tokens[index]
+        except IndexError:
+            return None
 
 
     def currentToken(self):
-        if self.index < len(self.tokens):
-            token = self.tokens[self.index]
-            self.current_line = token.line_number
-            return token
-        return Token("EOF", "", self.current_line)
+        token = self.token
+        if token is None:
+            return EOF_TOKEN
+        self.current_line = token.line_number
+        return token
 
 
 
 
     def lookAhead(self, steps=1):
         """Look ahead n tokens without consuming them"""
-        if self.index + steps < len(self.tokens):
+        try:
             return self.tokens[self.index + steps]
-        return Token("EOF", "", self.current_line)
+        except IndexError:
+            return EOF_TOKEN
 
 
 
@@ -242,14 +1756,52 @@ class Parser:
     def nextToken(self):
         token = self.currentToken()
         self.last_matched_token = token
-        # Print token and lexeme in the required format
-        self.output_token(token)
-        self.index += 1
+        if self.observers and token.type != "EOF":
+            self.emitToken(token)
+        self.skipToken()
         return self.currentToken()
-   
-    def output_token(self, token):
-        if token.type != "EOF":
-            self.output_lines.append(f"Token: {token.type:<15} Lexeme: {token.lexeme}")
+
+
+    def skipToken(self):
+        """Advance past the current token without recording it."""
+        self.index += 1
+        if self.window is not None:
+            self.window.floor = self.index
+        try:
+            self.token = self.tokens[self.index]
+        except IndexError:
+            self.token = None
+
+    @property
+    def output_lines(self):
+        """Lines of the text trace, if it is being kept."""
+        return self.trace.lines if self.trace is not None else []
+
+
+    @property
+    def assemblyList(self):
+        """Listing text of the generated code."""
+        return list(self.code.listing())
+
+
+    # Events for observers - only reached when there are any
+    def bindObservers(self):
+        """Look up the observers' handlers once, rather than on every event."""
+        self.token_handlers = [observer.on_token for observer in self.observers]
+        self.production_handlers = [observer.on_production for observer in self.observers]
+        self.error_handlers = [observer.on_error for observer in self.observers]
+
+
+    def emitToken(self, token):
+        self.events += 1
+        for handler in self.token_handlers:
+            handler(token)
+
+
+    def emitError(self, line, message):
+        self.events += 1
+        for handler in self.error_handlers:
+            handler(line, message)
 
 
 
@@ -257,7 +1809,12 @@ class Parser:
     def match(self, expected_type, expected_lexeme=None):
         token = self.currentToken()
         if token.type == expected_type and (expected_lexeme is None or token.lexeme == expected_lexeme):
-            next_token = self.nextToken()
+            # What nextToken() does, without looking the token up again
+            self.last_matched_token = token
+            if self.observers and token.type != "EOF":
+                self.emitToken(token)
+            self.skipToken()
+            self.currentToken()
             return True
         else:
             expected_desc = f"{expected_type}{' ' + expected_lexeme if expected_lexeme else ''}"
@@ -269,207 +1826,134 @@ class Parser:
 
 
     def error(self, message):
-        error_msg = f"Syntax error at line {self.current_line}: {message}"
-        self.output_lines.append(error_msg)
         self.error_count += 1
-       
+        if self.observers:
+            self.emitError(self.current_line, message)
+
         # Enhanced error recovery with more context-aware decisions
         token = self.currentToken()
-       
-       
-           
+
+
+
         # Special case for endif/endwhile - don't skip these important structure markers
         if token.type == "keyword" and token.lexeme in ["endif", "endwhile", "else"]:
             return
-               
+
         # More robust error recovery - skip to a synchronizing token
         recovery_attempted = False
-        while self.index < len(self.tokens):
+        while self.tokenAt(self.index) is not None:
             token = self.currentToken()
-           
+
             # Stop at semicolons - a common statement boundary
             if (token.type == "separator" and token.lexeme == ";"):
                 self.nextToken()  # Consume the semicolon
                 recovery_attempted = True
                 break
-               
+
             # Stop at keywords that often start statements
             elif (token.type == "keyword" and
                     token.lexeme in ["if", "while", "function", "return", "endif", "endwhile", "else"]):
                 recovery_attempted = True
                 break
-               
+
             # Stop at section separators
             elif token.type == "separator" and token.lexeme == "$$":
                 recovery_attempted = True
                 break
-               
+
             # Stop at closing braces - end of block
             elif token.type == "separator" and token.lexeme == "}":
                 recovery_attempted = True
                 break
-               
+
             else:
-                self.index += 1  # Skip the current token
-       
+                self.skipToken()  # Skip the current token
+
         # If we couldn't find a synchronizing token, advance just one token to avoid infinite loops
-        if not recovery_attempted and self.index < len(self.tokens):
-            self.index += 1
+        if not recovery_attempted and self.tokenAt(self.index) is not None:
+            self.skipToken()
 
 
 
 
-    def printProduction(self, production):
-        if self.print_productions:
-            self.output_lines.append(production)
+    def printProduction(self, production_id):
+        # Called for every production, so the handlers are called here rather than through a helper
+        if self.observers:
+            self.events += 1
+            for handler in self.production_handlers:
+                handler(production_id)
+
+
+    def site(self):
+        """Line and event position, within the section, of a check made at this point."""
+        return (self.current_line - self.section_line, self.events - self.section_mark)
+
+
+    def report(self, site, message):
+        """Record a semantic error found by analyze() or generate() at a site in the current section."""
+        line, mark = site
+        self.diagnostics.append((self.section.mark + mark, self.section.line + line, message, False))
+        self.error_count += 1
+
+
+
+
+    def warn(self, site, message):
+        """Record a warning, which is not counted as an error, at a site in the current section."""
+        line, mark = site
+        self.diagnostics.append((self.section.mark + mark, self.section.line + line, message, True))
 
 
     # Scope Management - can track types
     def enterScope(self):
         """Create a new scope."""
-        self.scope_stack.append({})  # Dictionary
+        self.scopes.enter()
 
 
 
 
     def exitScope(self):
         """Exit the current scope."""
-        if self.scope_stack:
-            self.scope_stack.pop()
+        self.scopes.exit()
 
 
 
 
-    def declareVariable(self, var_name, var_type):
+    def declareVariable(self, symbol, var_type, site):
         """Declare a variable with its type in the current scope or globally."""
-        if self.scope_stack:
-            # Check if variable exists in the current scope (not the entire stack)
-            if var_name not in self.scope_stack[-1]:
-                self.scope_stack[-1][var_name] = var_type
-            else:
-                self.error(f"{var_name} already declared. Declaration unnecessary.")
+        if self.scopes.depth:
+            # Only a declaration in the same scope (not an outer one) clashes
+            declared = self.scopes.declare(symbol, var_type)
         else:
-            if var_name not in self.global_vars:
-                if len(self.global_vars) == 0:
-                    memAddr = 10000
-                else:
-                    memAddr = self.memAddrList[-1] + 1
-                self.global_vars[var_name] = var_type
-                self.memAddrList.append(memAddr)
-            else:
-                self.error(f"{var_name} already declared. Declaration unnecessary.")
-
-
+            declared = self.symbol_table.declare(symbol, var_type, self.section.line + site[0]) is not None
+        if not declared:
+            self.report(site, f"{self.symbols.name(symbol)} already declared. Declaration unnecessary.")
 
 
-    def isVariableDeclared(self, var_name):
-        """Check if a variable is declared in any accessible scope."""
-        for scope in reversed(self.scope_stack):
-            if var_name in scope:
-                return True
-        return var_name in self.global_vars
 
 
-
-
-    def getVariableType(self, var_name):
-        """Get the type of a declared variable."""
-        for scope in reversed(self.scope_stack):
-            if var_name in scope:
-                return scope[var_name]
-        if var_name in self.global_vars:
-            return self.global_vars[var_name]
-        return None
+    def lookupVariable(self, symbol):
+        """Type of a variable in the innermost scope declaring it, or None if it is not declared."""
+        var_type = self.scopes.type(symbol)
+        if var_type is None:
+            return self.symbol_table.type(symbol)
+        return var_type
 
 
 
 
     # Type checking helpers
-    def areTypesCompatible(self, target_type, expr_type):
+    def areTypesCompatible(self, target_type, expr_type, bare=False):
         """Check if an expression type is compatible with a target variable type."""
         if target_type == expr_type:
             return True
-    
-        # Special case for boolean and integer 0/1
-        if target_type == "boolean" and expr_type == "integer":
-            # Look at the current token directly
-            curr_idx = self.index - 1  # Start from one position back
-        
-            # Find the relevant integer token that would be part of this assignment
-            integer_token = None
-            for i in range(curr_idx, max(0, curr_idx - 5), -1):
-                if i < len(self.tokens) and self.tokens[i].type == "integer" and self.tokens[i].lexeme in ["0", "1"]:
-                    integer_token = self.tokens[i]
-                    break
-            
-            if integer_token and integer_token.lexeme in ["0", "1"]:
-                # Look for operators that would make this part of an expression
-                has_operators = False
-                for i in range(curr_idx, max(0, curr_idx - 5), -1):
-                    if i < len(self.tokens) and self.tokens[i].type == "operator" and self.tokens[i].lexeme in ["+", "-", "*", "/"]:
-                        has_operators = True
-                        break
-                
-                # If it's a simple 0 or 1 without operators, allow the conversion
-                if not has_operators:
-                    return True
-        
-        # No automatic type conversions allowed between booleans and numeric types
-        if target_type == "boolean" or expr_type == "boolean":
-            return False
-        
-        return False
-
-
 
+        # Special case for boolean and a bare integer 0/1 literal
+        if target_type == "boolean" and expr_type == "integer" and bare:
+            return True
 
-    def determineExpressionType(self):
-        """Determine the type of an expression at the current position."""
-        token = self.currentToken()
-   
-        # Handle simple literals
-        if token.type == "integer":
-            return "integer"
-        elif token.type == "keyword" and token.lexeme in ["true", "false"]:
-            return "boolean"
-        elif token.type == "identifier":
-            # Check if it's a function call
-            next_token = self.lookAhead()
-            if next_token.type == "separator" and next_token.lexeme == "(":
-                # It's a function call, get its return type
-                if token.lexeme in self.functions and isinstance(self.functions[token.lexeme], dict):
-                    return self.functions[token.lexeme].get("return_type", "unknown")
-                return "unknown"
-            # Otherwise it's a variable
-            return self.getVariableType(token.lexeme)
-           
-        # For parenthesized expressions
-        if token.type == "separator" and token.lexeme == "(":
-            # Save position
-            saved_index = self.index
-               
-            # Skip the opening parenthesis
-            self.index += 1
-               
-            # Try to determine the type of the expression inside
-            expr_type = self.determineExpressionType()
-               
-            # Restore position
-            self.index = saved_index
-               
-            return expr_type
-           
-        # Check for operations (addition, subtraction, multiplication, division)
-        # Look ahead for operators
-        next_idx = self.index + 1
-        while next_idx < len(self.tokens):
-            next_token = self.tokens[next_idx]
-            # If we find an operator, the expression will be of integer type
-            if next_token.type == "operator" and next_token.lexeme in ["+", "-", "*", "/"]:
-                return "integer"
-            next_idx += 1
-       
-        return "unknown"
+        # No automatic type conversions allowed between booleans and numeric types
+        return False
 
 
 
@@ -478,246 +1962,377 @@ class Parser:
 
     # Parsing Functions with the Production Rules
     def parseProgram(self):
-        self.printProduction("<Program> -> <Statement List>")
-        self.parseStatementList()
+        # The tree has no reference cycles, so the cycle collector is held off
+        # rather than rescanning every node built so far as the tree grows
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self.printProduction(P_PROGRAM)
+            self.program = Program(self.parseStatementList())
+            self.analyze()
+            self.generate()
+            # Observers get the errors with the position the parser reached the code they are about at
+            for position, line, message, warning in self.diagnostics:
+                for observer in self.observers:
+                    if warning:
+                        observer.on_warning(line, message, position)
+                    else:
+                        observer.on_error(line, message, position)
+        finally:
+            if collecting:
+                gc.enable()
 
 
 
 
     def parseStatementList(self):
-        self.printProduction("<Statement List> -> <Statement> <Statement List> | ε")
-       
-        while self.index < len(self.tokens) and self.currentToken().type != "EOF":
+        self.printProduction(P_STATEMENT_LIST)
+
+        sections = []
+        while self.currentToken().type != "EOF":
             token = self.currentToken()
-           
+
             # Handle section separator
             if token.type == "separator" and token.lexeme == "$$":
                 self.match("separator", "$$")
                 continue
-               
+
             # Check for end of block markers - these are handled by their parent statements
             if (token.type == "keyword" and
                 token.lexeme in ["endif", "endwhile", "else"]):
                 break
-               
-            # Try to parse a statement, but allow for error recovery
+
+            sections.append(self.parseSection())
+        return sections
+
+
+
+
+    def parseListedStatement(self):
+        # Try to parse a statement, but allow for error recovery
+        try:
+            return self.parseStatement()
+        except MemoryError:
+            # Recovering would only fail again; whoever set the memory limit reports it
+            raise
+        except Exception as e:
+            # Attempt recovery to continue parsing
+            self.error(f"Exception: {str(e)}")
+            # Ensure we advance at least one token to avoid infinite loops
+            if self.tokenAt(self.index) is not None:
+                self.skipToken()
+            # A statement cut short by an exception is not worth caching
+            self.section_clean = False
+            return None
+
+
+
+
+    # Sections - the statements between two $$ separators, which can be reused from the cache
+    def parseSection(self):
+        """Parse statements up to the next $$, or reuse a cached parse of them."""
+        start = self.index
+        self.currentToken()
+        self.section_line = self.current_line
+        self.section_mark = self.events
+        section = Section([], self.section_line, self.section_mark)
+
+        key = None
+        if self.section_cache is not None:
+            # Only sections closed by $$ are cached, and no two sections of a program share nodes
+            end = self.findSeparator(start)
+            if end is not None:
+                key = self.sectionKey(start, end, self.section_line)
+                if key in self.section_keys:
+                    key = None
+            if key is not None:
+                self.section_keys.add(key)
+                entry = self.section_cache.get(key)
+                if entry is not None:
+                    self.replaySection(entry, start)
+                    section.statements = entry["statements"]
+                    self.index = end
+                    self.token = self.tokenAt(end)
+                    return section
+
+        error_count = self.error_count
+        self.section_clean = True
+        recorder = None
+        if key is not None and self.observers:
+            recorder = SectionRecorder(self, start)
+            self.observers.append(recorder)
+            self.bindObservers()
+        try:
+            section.statements = self.parseSectionStatements()
+        finally:
+            if recorder is not None:
+                self.observers.remove(recorder)
+                self.bindObservers()
+        # A section whose statements stop anywhere but its own $$ was not parsed on its own
+        if key is None or not self.section_clean or self.index != end:
+            return section
+
+        # Tokens and error lines are recorded relative to where the section starts
+        self.section_cache.put(key, {"events": recorder.events if recorder is not None else None,
+                                     "errors": recorder.errors if recorder is not None else None,
+                                     "error_count": self.error_count - error_count,
+                                     "statements": section.statements})
+        return section
+
+
+
+
+    def findSeparator(self, index):
+        """Index of the first $$ at or after index, or None if there is none."""
+        if isinstance(self.tokens, TokenStream):
             try:
-                self.parseStatement()
-            except Exception as e:
-                print(f"Error during parsing: {e}")
-                # Attempt recovery to continue parsing
-                self.error(f"Exception: {str(e)}")
-                # Ensure we advance at least one token to avoid infinite loops
-                if self.index < len(self.tokens):
-                    self.index += 1
+                return self.tokens.kinds.index(LEXEME_KINDS["$$"], index)
+            except ValueError:
+                return None
+        while True:
+            token = self.tokenAt(index)
+            if token is None:
+                return None
+            if token.type == "separator" and token.lexeme == "$$":
+                return index
+            index += 1
+
+
+
+
+    def parseSectionStatements(self):
+        statements = []
+        while True:
+            token = self.currentToken()
+            if token.type == "EOF" or (token.type == "separator" and token.lexeme == "$$"):
+                return statements
+            if token.type == "keyword" and token.lexeme in ["endif", "endwhile", "else"]:
+                return statements
+            statement = self.parseListedStatement()
+            if statement is not None:
+                statements.append(statement)
+
+
+
+
+    def sectionKey(self, start, end, base_line):
+        """Fingerprint of everything parsing the section from start to the $$ at end depends on."""
+        # Positions in the tree count events, which are only counted if someone observes them
+        parts = [str(SECTION_CACHE_VERSION), str(bool(self.observers))]
+        last = end + 1  # parsing stops at the $$, and never looks past it
+        if isinstance(self.tokens, TokenStream):
+            # The source text from the section on fixes its tokens and their relative lines
+            tokens = self.tokens
+            source = tokens.source
+            text_start = tokens.starts[start]
+            text_end = tokens.starts[last - 1] + tokens.lengths[last - 1]
+            parts.append(tokens.kinds[start:last].tobytes().hex())
+            text = source[text_start:text_end]
+            parts.append(text if isinstance(text, str) else text.decode("latin-1"))
+        else:
+            for index in range(start, last):
+                token = self.tokenAt(index)
+                # Lexemes never contain \x1f, which counts as whitespace
+                parts.append(f"{token.type}\x1f{token.lexeme}\x1f{token.line_number - base_line}")
+        digest = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            data = part.encode("utf-8", "surrogatepass")
+            digest.update(len(data).to_bytes(8, "little"))
+            digest.update(data)
+        return digest.hexdigest()
+
+
+
+
+    def replaySection(self, entry, start):
+        """Report a cached section's events again, for the section's tokens starting at start."""
+        self.error_count += entry["error_count"]
+        if entry["events"] is None:
+            return
+        errors = iter(entry["errors"])
+        for event in entry["events"]:
+            if event < 0:
+                self.emitToken(self.tokens[start - event - 1])
+            elif event == ERROR_EVENT:
+                line, message = next(errors)
+                self.emitError(self.section_line + line, message)
+            else:
+                self.printProduction(event)
 
 
 
 
     def parseStatement(self):
-        self.printProduction("<Statement> -> <Compound> | <Assign> | <If> | <Return> | <Print> | <Scan> | <While> | <Declaration>")
-       
+        self.printProduction(P_STATEMENT)
+
         token = self.currentToken()
-       
+
         if token.type == "keyword" and token.lexeme == "function":
-            self.parseFunctionDef()
+            return self.parseFunctionDef()
         elif token.type == "keyword" and token.lexeme == "if":
-            self.parseIfStmt()
+            return self.parseIfStmt()
         elif token.type == "keyword" and token.lexeme == "while":
-            self.parseWhileStmt()
+            return self.parseWhileStmt()
         elif token.type == "keyword" and token.lexeme == "return":
-            self.parseReturnStmt()
+            return self.parseReturnStmt()
         elif token.type == "keyword" and token.lexeme in ["integer", "boolean"]:
-            self.parseVarDec()
+            return self.parseVarDec()
         elif token.type == "keyword" and token.lexeme == "print":
-            self.parsePrintStmt()
+            return self.parsePrintStmt()
         elif token.type == "keyword" and token.lexeme == "scan":
-            self.parseScanStmt()
+            return self.parseScanStmt()
         elif token.type == "identifier":
             # Look ahead to see if it's an assignment or function call
-            if self.index + 1 < len(self.tokens) and self.tokens[self.index + 1].type == "operator" and self.tokens[self.index + 1].lexeme == "=":
-                self.parseAssignment()
+            next_token = self.lookAhead()
+            if next_token.type == "operator" and next_token.lexeme == "=":
+                return self.parseAssignment()
             else:
-                self.parseFunctionCall()
+                return self.parseFunctionCall()
         elif token.type == "separator" and token.lexeme == "{":
-            self.parseCompound()
+            return self.parseCompound()
         else:
             # Special handling for keywords not recognized at statement level
             if token.type == "keyword":
                 if token.lexeme in ["endif", "endwhile", "else"]:
                     # These are handled by their respective statement parsers
-                    return
+                    return None
                 elif token.lexeme in ["true", "false"]:
                     # Boolean literals aren't statements on their own
                     self.error(f"Boolean literal '{token.lexeme}' cannot be used as a statement")
                     self.nextToken()
-                    return
-                   
+                    return None
+
             self.error(f"Unexpected token in statement: {token.lexeme}")
             # Move past the problematic token
             self.nextToken()
+            return None
 
 
 
 
     def parseCompound(self):
-        self.printProduction("<Compound> -> { <Statement List> }")
-        self.enterScope()
-       
+        self.printProduction(P_COMPOUND)
+        compound = Compound([])
+
         if not self.match("separator", "{"):
-            self.exitScope()
-            return
-           
+            return compound
+
         # Parse statements until we encounter a closing brace or EOF
-        while (self.index < len(self.tokens) and
+        while (self.currentToken().type != "EOF" and
                (self.currentToken().type != "separator" or self.currentToken().lexeme != "}")):
-            if self.currentToken().type == "EOF":
-                self.error("Unexpected end of file in compound statement")
-                self.exitScope()
-                return
-           
             # Check for end of block markers inside compound statement
             token = self.currentToken()
             if (token.type == "keyword" and
                 token.lexeme in ["endif", "endwhile"]):
                 break
-               
-            self.parseStatement()
-       
+
+            start = self.index
+            statement = self.parseStatement()
+            if statement is not None:
+                compound.statements.append(statement)
+            if self.index == start:
+                # A stray else is left where it is, and would be met again forever
+                self.error(f"Unexpected token in statement: {self.currentToken().lexeme}")
+                self.nextToken()
+
         self.match("separator", "}")
-        self.exitScope()
-       
+        return compound
+
     def parseFunctionDef(self):
-        self.printProduction("<Function> -> function <Identifier> ( <Parameter List> ) <Compound>")
+        self.printProduction(P_FUNCTION)
 
 
         if not self.match("keyword", "function"):
-            return
-   
-        function_name = self.currentToken().lexeme
-        if function_name in self.functions:
-            self.error(f"Function {function_name} already defined")
+            return None
+
+        token = self.currentToken()
+        function = Function(token.symbol, token.lexeme, self.site())
 
 
         if not self.match("identifier"):
-            return
-   
+            return function
+
         if not self.match("separator", "("):
-            return
+            return function
 
 
-        self.enterScope()
-        params = self.parseParameterList()  # Modified to return parameter info
-   
-        # Add a placeholder for return type - it'll be determined by return statements
-        self.functions[function_name] = {"params": params, "return_type": "unknown"}  # Changed to unknown
-   
+        function.params = self.parseParameterList()
+
         if not self.match("separator", ")"):
-            self.exitScope()
-            return
-           
-        self.parseCompound()
-        self.exitScope()
-       
+            return function
+
+        function.body = self.parseCompound()
+        return function
+
     def parseScanStmt(self):
-        self.printProduction("<Scan> -> scan ( <IDs> );")
-   
+        self.printProduction(P_SCAN)
+
         if not self.match("keyword", "scan"):
-            return
-       
+            return None
+
         if not self.match("separator", "("):
-            return
-       
+            return None
+
         # Collect variables being scanned to later add their POPM instructions
-        scanned_vars = []
-        self.parseIDsScan(scanned_vars)
-   
+        scan = Scan([])
+        self.parseIDsScan(scan.targets)
+
         if not self.match("separator", ")"):
-            return
-       
+            return scan
+
         self.match("separator", ";")
+        scan.complete = True
+        return scan
 
 
-        # Append SIN instruction
-        self.assemblyList.append("SIN")
-       
-        # POPM instructions for each variable in reversed order
-        for var_name in reversed(scanned_vars):
-            # Get memory address for the variable
-            mem_addr = None
-            for i, var in enumerate(self.global_vars.keys()):
-                if var == var_name:
-                    mem_addr = self.memAddrList[i]
-                    break
-           
-            # Add POPM instruction to store the input value into variable's memory location
-            if mem_addr is not None:
-                self.assemblyList.append(f"POPM      {mem_addr}")
+    def parseIDsScan(self, targets):
+        """Parse IDs for scan statement"""
+        self.printProduction(P_IDS)
 
+        token = self.currentToken()
+        # Each variable is checked for a prior declaration where it is read
+        targets.append((token.symbol, token.lexeme, self.site()))
 
-    def parseIDsScan(self, scanned_vars=None):
-        """Parse IDs for scan statement with validation for declared variables"""
-        self.printProduction("<IDs> -> <Identifier> <IDsPrime>")
-   
-        var_name = self.currentToken().lexeme
-   
-        # Check if variable is declared before scanning
-        if not self.isVariableDeclared(var_name):
-            self.error(f"Variable '{var_name}' used in scan procedure without prior declaration.")
-   
-        # Add variable to the list of scanned variables
-        if scanned_vars is not None:
-            scanned_vars.append(var_name)
-   
         if not self.match("identifier"):
             return
-   
-        self.parseIDsPrimeScan(scanned_vars)
 
+        self.parseIDsPrimeScan(targets)
+
+
+    def parseIDsPrimeScan(self, targets):
+        self.printProduction(P_IDS_PRIME)
 
-    def parseIDsPrimeScan(self, scanned_vars=None):
-        self.printProduction("<IDsPrime> -> , <Identifier> <IDsPrime> | ε")
-   
         if self.currentToken().type == "separator" and self.currentToken().lexeme == ",":
             self.match("separator", ",")
-            var_name = self.currentToken().lexeme
-       
-            if not self.isVariableDeclared(var_name):
-                self.error(f"Variable '{var_name}' used in scan procedure without prior declaration.")
-       
-            # Add variable to the list of scanned variables
-            if scanned_vars is not None:
-                scanned_vars.append(var_name)
-       
+            token = self.currentToken()
+            targets.append((token.symbol, token.lexeme, self.site()))
+
             if not self.match("identifier"):
                 return
-           
-            self.parseIDsPrimeScan(scanned_vars)
+
+            self.parseIDsPrimeScan(targets)
         else:
-            self.printProduction("<IDsPrime> -> ε")
+            self.printProduction(P_IDS_PRIME_EMPTY)
 
 
 
 
     def parsePrintStmt(self):
-        self.printProduction("<Print> -> print ( <Expression> );")
-   
+        self.printProduction(P_PRINT)
+
         if not self.match("keyword", "print"):
-            return
-       
+            return None
+
         if not self.match("separator", "("):
-            return
-   
-        # Parse expression normally without skipping PUSHM instructions
-        self.parseExpression()
-   
-        # Append a SOUT instruction after expression is parsed
-        self.assemblyList.append("SOUT")
-   
+            return None
+
+        node = Print(self.parseExpression())
+
         if not self.match("separator", ")"):
-            return
-       
+            return node
+
         self.match("separator", ";")
+        return node
 
 
 
@@ -725,29 +2340,29 @@ class Parser:
 
 
     def parseParameterList(self):
-        self.printProduction("<Parameter List> -> <Parameter> <Parameter List Prime> | ε")
-   
+        self.printProduction(P_PARAMETER_LIST)
+
         params = []
-   
+
         # Check if we're at a parameter
         if self.currentToken().type == "identifier":
-            param = self.parseParameter()  # return name and type
+            param = self.parseParameter()
             if param:
                 params.append(param)
-            params.extend(self.parseParameterListPrime())  # return parameters
+            params.extend(self.parseParameterListPrime())
         else:
-            self.printProduction("<Parameter List> -> ε")
-       
+            self.printProduction(P_PARAMETER_LIST_EMPTY)
+
         return params
 
 
 
 
     def parseParameterListPrime(self):
-        self.printProduction("<Parameter List Prime> -> , <Parameter> <Parameter List Prime> | ε")
-   
+        self.printProduction(P_PARAMETER_LIST_PRIME)
+
         params = []
-   
+
         if self.currentToken().type == "separator" and self.currentToken().lexeme == ",":
             self.match("separator", ",")
             param = self.parseParameter()
@@ -755,44 +2370,37 @@ class Parser:
                 params.append(param)
             params.extend(self.parseParameterListPrime())
         else:
-            self.printProduction("<Parameter List Prime> -> ε")
-       
+            self.printProduction(P_PARAMETER_LIST_PRIME_EMPTY)
+
         return params
 
 
 
 
     def parseParameter(self):
-        self.printProduction("<Parameter> -> <IDs> <Qualifier>")
-   
+        self.printProduction(P_PARAMETER)
+
         var_name = self.currentToken().lexeme
+        symbol = self.currentToken().symbol
         if not self.match("identifier"):
             return None
-   
-        # Store the variable name temporarily
-        temp_var_name = var_name
-   
+
         # Get the type from qualifier
         token = self.currentToken()
         var_type = token.lexeme if token.type == "keyword" and token.lexeme in ["integer", "boolean"] else "unknown"
-   
+
         self.parseQualifier()
-   
-        # Now declare the variable with its type
-        self.declareVariable(temp_var_name, var_type)
-   
-        return (temp_var_name, var_type)
+
+        return Parameter(symbol, var_name, var_type, self.site())
 
 
 
 
     def parseQualifier(self):
-        self.printProduction("<Qualifier> -> integer | boolean")
-       
+        self.printProduction(P_QUALIFIER)
+
         token = self.currentToken()
         if token.type == "keyword" and token.lexeme in ["integer", "boolean"]:
-            # Store the current variable type
-            self.current_var_type = token.lexeme
             self.match("keyword", token.lexeme)
         else:
             self.error("Type qualifier expected (integer or boolean)")
@@ -801,285 +2409,124 @@ class Parser:
 
 
     def parseIfStmt(self):
-        self.printProduction("<If> -> if ( <Condition> ) <Statement> <IfPrime>")
-   
-        # Scope for the entire if/else structure
-        self.enterScope()
-        previous_if_body = self.in_if_body
-        self.in_if_body = True
-   
+        self.printProduction(P_IF)
+
         if not self.match("keyword", "if"):
-            self.in_if_body = previous_if_body
-            self.exitScope()
-            return
-           
+            return None
+
         if not self.match("separator", "("):
-            self.in_if_body = previous_if_body
-            self.exitScope()
-            return
-       
-        # Save pos to add the JMP0 instruction at a future time
-        condition_position = len(self.assemblyList)
-       
-        self.parseCondition()
-       
+            return None
+
+        node = If(self.parseCondition())
+
         if not self.match("separator", ")"):
-            self.in_if_body = previous_if_body
-            self.exitScope()
-            return
-       
-        # Add JMP0 instruction with a placeholder for the label
-        self.assemblyList.append("JMP0      TBD")
-        jmp_position = len(self.assemblyList) - 1
-       
-        # Create a separate scope for the if body regardless of curly braces
-        self.enterScope()
-        self.parseStatement()
-        # Exit the if body scope before entering else
-        self.exitScope()
-       
-        # If there's an else coming, add a jump to skip it after the 'if' body completes
+            return node
+
+        node.complete = True
+        node.then_branch = self.parseStatement()
+
+        # An else branch is taken if the statement is followed by else
         next_token = self.currentToken()
-        if next_token.type == "keyword" and next_token.lexeme == "else":
-            self.assemblyList.append("JMP0       TBD")
-            else_jmp_position = len(self.assemblyList) - 1
-           
-            # Add label for the else part. This is where JMP0 should jump to if condition is false
-            self.assemblyList.append("LABEL")
-            else_label_position = len(self.assemblyList) - 1
-           
-            # Update the JMP0 instruction with the correct label position
-            self.assemblyList[jmp_position] = f"JMP0      {else_label_position + 1}"
-        else:
-            # Add label where to jump if condition is false
-            self.assemblyList.append("LABEL")
-            end_if_label_position = len(self.assemblyList) - 1
-           
-            # Update the JMP0 instruction with the correct label position
-            self.assemblyList[jmp_position] = f"JMP0      {end_if_label_position + 1}"
-       
-        self.parseIfPrime()
-       
-        # If we had an else branch, resolve its jump position here
-        if next_token.type == "keyword" and next_token.lexeme == "else":
-            # Add label for the end of the if/else structure
-            self.assemblyList.append("LABEL")
-            end_label_position = len(self.assemblyList) - 1
-           
-            # Update the JMP instruction that skips the else block
-            self.assemblyList[else_jmp_position] = f"JMP       {end_label_position + 1}"
-       
-        self.in_if_body = previous_if_body
-        # Exit the overall if-else construct scope
-        self.exitScope()
+        node.has_else = next_token.type == "keyword" and next_token.lexeme == "else"
+        node.else_branch = self.parseIfPrime()
+        return node
 
 
 
 
     def parseIfPrime(self):
-        self.printProduction("<IfPrime> -> else <Statement> endif | endif")
-       
+        self.printProduction(P_IF_PRIME)
+
         token = self.currentToken()
+        statement = None
         if token.type == "keyword" and token.lexeme == "else":
             self.match("keyword", "else")
-            # Create a separate scope for the else statement
-            self.enterScope()
-            self.parseStatement()
-            self.exitScope()
+            statement = self.parseStatement()
             if not self.match("keyword", "endif"):
                 self.error("Expected 'endif' after else clause")
         elif token.type == "keyword" and token.lexeme == "endif":
             self.match("keyword", "endif")
         else:
             self.error("Expected 'else' or 'endif'")
+        return statement
 
 
 
 
     def parseWhileStmt(self):
-        self.printProduction("<While> -> while ( <Condition> ) <Statement List> endwhile")
-   
-        self.enterScope()
-        previous_loop_body = self.in_loop_body
-        self.in_loop_body = True
-   
+        self.printProduction(P_WHILE)
+
         if not self.match("keyword", "while"):
-            self.in_loop_body = previous_loop_body
-            self.exitScope()
-            return
-       
+            return None
+
         if not self.match("separator", "("):
-            self.in_loop_body = previous_loop_body
-            self.exitScope()
-            return
-       
-        # Add LABEL at the beginning of while loop
-        self.assemblyList.append("LABEL")
-        start_label_position = len(self.assemblyList) - 1
-           
-        self.parseCondition()
-       
+            return None
+
+        node = While(self.parseCondition())
+
         if not self.match("separator", ")"):
-            self.in_loop_body = previous_loop_body
-            self.exitScope()
-            return
-       
-        # Add JMP0 instruction with a placeholder to be updated after we know where the loop ends
-        self.assemblyList.append("JMP0      TBD")
-        jmp0_position = len(self.assemblyList) - 1
-       
+            return node
+
+        node.complete = True
         # Check if the next token is an opening brace
         if self.currentToken().type == "separator" and self.currentToken().lexeme == "{":
-            self.parseCompound()
+            node.body.append(self.parseCompound())
         else:
-            prev_index = self.index  # Save the current position
-           
             # Parse the statement
-            self.parseStatement()
-           
-            # Check if endwhile immediately follows
-            if self.currentToken().type == "keyword" and self.currentToken().lexeme == "endwhile":
-                pass
-            else:
-                # If we didn't immediately hit endwhile, continue parsing statements
-                while (self.index < len(self.tokens) and
-                      not (self.currentToken().type == "keyword" and
-                            self.currentToken().lexeme == "endwhile")):
-                    if self.currentToken().type == "EOF":
-                        self.error("Unexpected end of file in while loop")
-                        self.in_loop_body = previous_loop_body
-                        self.exitScope()
-                        return
-                       
-                    # Check for separators that should end the loop
-                    if self.currentToken().type == "separator" and self.currentToken().lexeme == "$$":
-                        self.error("Expected 'endwhile' before end of section")
-                        break
-                       
-                    # Continue parsing statements in the loop body
-                    self.parseStatement()
-       
-        # Add unconditional JMP back to the condition evaluation
-        self.assemblyList.append(f"JMP       {start_label_position + 1}")
-       
-        # Add LABEL for the end of the loop where we jump to if condition is false
-        self.assemblyList.append("LABEL")
-        end_label_position = len(self.assemblyList) - 1
-       
-        # Update the JMP0 instruction with the correct label position
-        self.assemblyList[jmp0_position] = f"JMP0      {end_label_position + 1}"
-       
+            statement = self.parseStatement()
+            if statement is not None:
+                node.body.append(statement)
+
+            # If we didn't immediately hit endwhile, continue parsing statements
+            while (self.currentToken().type != "EOF" and
+                  not (self.currentToken().type == "keyword" and
+                        self.currentToken().lexeme == "endwhile")):
+                # Check for separators that should end the loop
+                if self.currentToken().type == "separator" and self.currentToken().lexeme == "$$":
+                    self.error("Expected 'endwhile' before end of section")
+                    break
+
+                # Continue parsing statements in the loop body
+                start = self.index
+                statement = self.parseStatement()
+                if statement is not None:
+                    node.body.append(statement)
+                if self.index == start:
+                    # A stray endif or else is left where it is, and would be met again forever
+                    self.error(f"Unexpected token in statement: {self.currentToken().lexeme}")
+                    self.nextToken()
+
         # matching of the endwhile keyword
         if self.currentToken().type == "keyword" and self.currentToken().lexeme == "endwhile":
             self.match("keyword", "endwhile")
         else:
             self.error("Expected 'endwhile' to close while loop")
-           
-        self.in_loop_body = previous_loop_body
-        self.exitScope()
+        return node
 
 
 
 
     def parseCondition(self):
-        self.printProduction("<Condition> -> <Expression> <Relop> <Expression>")
-       
-        # Save position before parsing first expression
-        expr1_start_index = self.index
-       
-        self.parseExpression()
-       
+        self.printProduction(P_CONDITION)
+
+        left = self.parseExpression()
+
         # Save the operator token
         relop_token = self.currentToken()
-        relop_operator = relop_token.lexeme
         self.parseRelop()
-       
-        # Save position before parsing second expression
-        expr2_start_index = self.index
-       
-        self.parseExpression()
-       
-        # Add comparison instruction based on type of relational operator
-        if relop_operator == "==":
-            self.assemblyList.append("EQU")
-        elif relop_operator == "!=":
-            self.assemblyList.append("NEQ")
-        elif relop_operator == ">":
-            self.assemblyList.append("GRT")
-        elif relop_operator == "<":
-            self.assemblyList.append("LES")
-        elif relop_operator == "<=":
-            self.assemblyList.append("LEQ")
-        elif relop_operator == "=>":
-            self.assemblyList.append("GEQ")
-       
-        # Reset to determine expression types
-        saved_index = self.index
-       
-        # Determine type of first expression
-        self.index = expr1_start_index
-        left_type = self.determineExpressionType()
-       
-        # Determine type of second expression
-        self.index = expr2_start_index
-        right_type = self.determineExpressionType()
-       
-        # Restore position
-        self.index = saved_index
-       
-        # Type checking for comparison operators
-        if left_type != "unknown" and right_type != "unknown" and left_type != right_type:
-            # Special case: Allow comparison between boolean and integer literals 0 and 1 (but cannot be expressions)
-            special_case = False
-           
-            # Check if one is boolean and the other is integer
-            if (left_type == "boolean" and right_type == "integer"):
-                # Check if the right side is just a simple 0 or 1 literal with no operations
-                temp_idx = self.index
-                self.index = expr2_start_index
-               
-                # Check if the token is a simple integer literal
-                token = self.currentToken()
-                if token.type == "integer" and token.lexeme in ["0", "1"]:
-                    # Look ahead for any operators that would make this a complex expression
-                    has_operators = False
-                    for i in range(expr2_start_index, saved_index):
-                        if i < len(self.tokens) and self.tokens[i].type == "operator" and self.tokens[i].lexeme in ["+", "-", "*", "/"]:
-                            has_operators = True
-                            break
-                   
-                    if not has_operators:
-                        special_case = True
-               
-                self.index = temp_idx
-            elif (right_type == "boolean" and left_type == "integer"):
-                # Check if the left side is just a simple 0 or 1 literal with no operations
-                temp_idx = self.index
-                self.index = expr1_start_index
-               
-                # Check if the token is a simple integer literal
-                token = self.currentToken()
-                if token.type == "integer" and token.lexeme in ["0", "1"]:
-                    # Look ahead for any operators that would make this a complex expression
-                    has_operators = False
-                    for i in range(expr1_start_index, expr2_start_index - 1):  # -1 to exclude the relop
-                        if i < len(self.tokens) and self.tokens[i].type == "operator" and self.tokens[i].lexeme in ["+", "-", "*", "/"]:
-                            has_operators = True
-                            break
-                   
-                    if not has_operators:
-                        special_case = True
-               
-                self.index = temp_idx
-           
-            # If not a special case (simple integer 0 or 1 with boolean), then report an error
-            if not special_case:
-                self.error(f"Type mismatch: You cannot compare {left_type} with {right_type} using {relop_token.lexeme}")
+
+        line = self.current_line - self.section_line
+        right = self.parseExpression()
+
+        # The comparison is checked from where the right side starts
+        return Condition(left, relop_token.lexeme, right, (line, self.events - self.section_mark))
+
+
 
 
     def parseRelop(self):
-        self.printProduction("<Relop> -> == | != | > | < | <= | =>")
-       
+        self.printProduction(P_RELOP)
+
         token = self.currentToken()
         if token.type == "operator" and token.lexeme in ["==", "!=", ">", "<", "<=", "=>"]:
             self.match("operator", token.lexeme)
@@ -1090,535 +2537,859 @@ class Parser:
 
 
     def parseReturnStmt(self):
-        self.printProduction("<Return> -> return <Expression> ;")
-   
+        self.printProduction(P_RETURN)
+
         if not self.match("keyword", "return"):
-            return
-   
-        # Save position before parsing expression to determine its type
-        expr_start_index = self.index
-   
-        self.parseExpression()
-   
-        # Determine the expression type being returned
-        saved_index = self.index
-        self.index = expr_start_index
-        return_type = self.determineExpressionType()
-        self.index = saved_index
-   
-        # Update the containing function's return type if we're in a function
-        # Find the function we're currently in by looking at tokens.
-        for i in range(self.index - 1, -1, -1):
-            if (i < len(self.tokens) and
-                self.tokens[i].type == "identifier" and
-                self.tokens[i].lexeme in self.functions and
-                i > 0 and self.tokens[i-1].type == "keyword" and
-                self.tokens[i-1].lexeme == "function"):
-               
-                function_name = self.tokens[i].lexeme
-                # Update the return type
-                if function_name in self.functions:
-                    self.functions[function_name]["return_type"] = return_type
-                break
-   
+            return None
+
+        # analyzeReturn() checks its type against the function on top of function_stack
+        node = Return(self.parseExpression())
+
         if not self.match("separator", ";"):
             self.error("Expected semicolon after return statement")
+        return node
 
 
 
 
     def parseAssignment(self):
-        self.printProduction("<Assign> -> <Identifier> = <Expression> ;")
-   
-        var_name = self.currentToken().lexeme
-   
-        # Check if variable is declared
-        if not self.isVariableDeclared(var_name):
-            self.error(f"Variable '{var_name}' used before declaration")
-            # Continue parsing but flag the error
-   
-        # Get the variable's declared type
-        var_type = self.getVariableType(var_name)
-   
+        self.printProduction(P_ASSIGN)
+
+        token = self.currentToken()
+        # The variable must be declared where it is named
+        node = Assign(token.symbol, token.lexeme, self.site())
+
         if not self.match("identifier"):
-            return
-       
+            return node
+
         if not self.match("operator", "="):
-            return
-   
-        # Save position before parsing expression
-        expr_start_index = self.index
-   
-        # Parse expression normally
-        self.parseExpression()
-   
-        # Type checking logic
-        # Reset to start of expression for type determination
-        saved_index = self.index
-        self.index = expr_start_index
-       
-        # Determine the expression type
-        expr_type = self.determineExpressionType()
-       
-        # Restore position
-        self.index = saved_index
-       
-        # Type compatibility check
-        if expr_type != "unknown" and var_type != "unknown" and var_type != expr_type:
-            # Check if the types are compatible
-            if not self.areTypesCompatible(var_type, expr_type):
-                self.error(f"Type mismatch: Cannot assign {expr_type} value to {var_type} variable '{var_name}'")
-       
-        # Get memory address for the variable
-        mem_addr = None
-        for i, var in enumerate(self.global_vars.keys()):
-            if var == var_name:
-                mem_addr = self.memAddrList[i]
-                break
-       
-        # Add POPM instruction to store the value into variable's memory location
-        if mem_addr is not None:
-            self.assemblyList.append(f"POPM      {mem_addr}")
-       
+            return node
+
+        # The assigned type is checked from where the expression starts
+        line = self.current_line - self.section_line
+        node.expression = self.parseExpression()
+        node.check = (line, self.events - self.section_mark)
+
         if not self.match("separator", ";"):
             self.error("Expected semicolon after assignment")
+        return node
 
 
 
 
     # Removed left recursion in Expression
     def parseExpression(self):
-        self.printProduction("<Expression> -> <Term> <ExpressionPrime>")
-       
-        self.parseTerm()
-        self.parseExpressionPrime()
+        self.printProduction(P_EXPRESSION)
+
+        left = self.parseTerm()
+        return self.parseExpressionPrime(left)
 
 
 
 
-    def parseExpressionPrime(self):
-        self.printProduction("<ExpressionPrime> -> + <Term> <ExpressionPrime> | - <Term> <ExpressionPrime> | ε")
+    def parseExpressionPrime(self, left):
+        self.printProduction(P_EXPRESSION_PRIME)
 
 
         token = self.currentToken()
         if token.type == "operator" and token.lexeme in ["+", "-"]:
             op = token.lexeme
             self.match("operator", op)
-   
-            # Store position before parsing term
-            term_start_index = self.index
-       
-            # Save current position to determine left operand type
-            left_start_index = self.index - 2  # Go back before the operator
-       
-            self.parseTerm()
-       
-            # Add the operation instruction
-            if op == "+":
-                self.assemblyList.append("A")
-            else:  # op == "-"
-                self.assemblyList.append("S")
-       
-            # Check for boolean operands
-            saved_index = self.index
-       
-            # Go back to determine left operand type
-            self.index = left_start_index
-            left_type = self.determineExpressionType()
-           
-            # Go to term position to determine its type
-            self.index = term_start_index
-            right_type = self.determineExpressionType()
-           
-            # Restore position
-            self.index = saved_index
-           
-            # Check for boolean operands on either side
-            if left_type == "boolean" or right_type == "boolean":
-                self.error(f"Cannot use {op} operator with boolean operands")
-               
-            self.parseExpressionPrime()
-        else:
-            self.printProduction("<ExpressionPrime> -> ε")
-
-
 
+            # The operands are checked from where the right one starts
+            line = self.current_line - self.section_line
+            right = self.parseTerm()
+            node = BinOp(op, left, right, (line, self.events - self.section_mark))
 
+            return self.parseExpressionPrime(node)
+        else:
+            self.printProduction(P_EXPRESSION_PRIME_EMPTY)
+            return left
 
 
 
 
     def parseTerm(self):
-        self.printProduction("<Term> -> <Factor> <TermPrime>")
-       
-        self.parseFactor()
-        self.parseTermPrime()
+        self.printProduction(P_TERM)
 
+        left = self.parseFactor()
+        return self.parseTermPrime(left)
 
 
 
-   
-    def parseTermPrime(self):
-        self.printProduction("<TermPrime> -> * <Factor> <TermPrime> | / <Factor> <TermPrime> | ε")
+
+    def parseTermPrime(self, left):
+        self.printProduction(P_TERM_PRIME)
 
 
         token = self.currentToken()
         if token.type == "operator" and token.lexeme in ["*", "/"]:
             op = token.lexeme
             self.match("operator", op)
-   
-            # Store position before parsing factor
-            factor_start_index = self.index
-           
-            # Save current position to determine left operand type
-            left_start_index = self.index - 2  # Go back before the operator
-           
-            self.parseFactor()
-           
-            # Add the operation instruction
-            if op == "*":
-                self.assemblyList.append("M")
-            else:  # op == "/"
-                self.assemblyList.append("D")
-           
-            # Check for boolean operands
-            saved_index = self.index
-           
-            # Go back to determine left operand type
-            self.index = left_start_index
-            left_type = self.determineExpressionType()
-       
-            # Go to factor position to determine its type
-            self.index = factor_start_index
-            right_type = self.determineExpressionType()
-           
-            # Restore position
-            self.index = saved_index
-           
-            # Check for boolean operands on either side
-            if left_type == "boolean" or right_type == "boolean":
-                self.error(f"Cannot use {op} operator with boolean operands")
-               
-            self.parseTermPrime()
-        else:
-            self.printProduction("<TermPrime> -> ε")
-
-
 
+            # The operands are checked from where the right one starts
+            line = self.current_line - self.section_line
+            right = self.parseFactor()
+            node = BinOp(op, left, right, (line, self.events - self.section_mark))
 
+            return self.parseTermPrime(node)
+        else:
+            self.printProduction(P_TERM_PRIME_EMPTY)
+            return left
 
 
 
 
     def parseFactor(self):
-        self.printProduction("<Factor> -> <Identifier> | <Number> | ( <Expression> ) | <Function Call>")
-       
+        self.printProduction(P_FACTOR)
+
         token = self.currentToken()
-       
+
         if token.type == "identifier":
-            id_name = token.lexeme
-            next_token = None if self.index + 1 >= len(self.tokens) else self.tokens[self.index + 1]
-           
+            next_token = self.lookAhead()
+
             # Check if it might be a function call
-            if next_token and next_token.type == "separator" and next_token.lexeme == "(":
-                self.parseFunctionCall()
-            else:
-                # Check if variable is declared
-                if not self.isVariableDeclared(id_name) and id_name not in self.functions:
-                    self.error(f"Variable '{id_name}' used before declaration")
-                else:
-                    # Get memory address for the variable
-                    mem_addr = None
-                    for i, var in enumerate(self.global_vars.keys()):
-                        if var == id_name:
-                            mem_addr = self.memAddrList[i]
-                            break
-                   
-                    # Only add PUSHM if not inside a print statement
-                    if mem_addr is not None and not getattr(self, 'in_print', False):
-                        self.assemblyList.append(f"PUSHM     {mem_addr}")
-               
-                self.match("identifier")
-               
+            if next_token.type == "separator" and next_token.lexeme == "(":
+                return self.parseFunctionCall()
+            # The variable must be declared where it is read
+            node = Factor("identifier", token.lexeme, token.symbol, self.site())
+            self.match("identifier")
+            return node
         elif token.type in ["integer"]:
-            # Add PUSHI instruction to push literal integers onto stack
-            if not getattr(self, 'in_print', False):
-                self.assemblyList.append(f"PUSHI     {token.lexeme}")
             self.match(token.type)
+            return Factor("integer", token.lexeme)
         elif token.type == "separator" and token.lexeme == "(":
             self.match("separator", "(")
-            self.parseExpression()
+            node = self.parseExpression()
             self.match("separator", ")")
+            return node
         elif token.type == "keyword" and token.lexeme in ["true", "false"]:
             # Handle boolean literals - convert to integers (0 or 1)
-            value = "1" if token.lexeme == "true" else "0"
-            if not getattr(self, 'in_print', False):
-                self.assemblyList.append(f"PUSHI     {value}")
             self.match("keyword")
+            return Factor("boolean", "1" if token.lexeme == "true" else "0")
         else:
             self.error(f"Unexpected token in factor: {token.lexeme}")
             # Skip the problematic token
             self.nextToken()
-
-
-
-
+            return Factor("error", token.lexeme)
 
 
 
 
     def parseVarDec(self):
-        self.printProduction("<Declaration> -> <Qualifier> <IDs> ;")
-       
+        self.printProduction(P_DECLARATION)
+
         # Get the type first
-        var_type = self.currentToken().lexeme  # integer or boolean
+        node = Declaration(self.currentToken().lexeme, [])  # integer or boolean
         self.parseQualifier()
-       
-        # Pass the type to parseIDs
-        self.parseIDs(var_type)
-       
+
+        self.parseIDs(node.names)
+
         if not self.match("separator", ";"):
             self.error("Expected semicolon after variable declaration")
+        return node
 
 
 
 
-    def parseIDs(self, var_type=None):
-        self.printProduction("<IDs> -> <Identifier> <IDsPrime>")
-       
-        var_name = self.currentToken().lexeme
+    def parseIDs(self, names):
+        self.printProduction(P_IDS)
+
+        symbol = self.currentToken().symbol
         if not self.match("identifier"):
             return
-           
-        if var_type:  # Store type if provided
-            self.declareVariable(var_name, var_type)
-        else:
-            self.declareVariable(var_name, "unknown")
-           
-        self.parseIDsPrime(var_type)
+
+        names.append((symbol, self.site()))
+        self.parseIDsPrime(names)
 
 
 
 
-    def parseIDsPrime(self, var_type=None):
-        self.printProduction("<IDsPrime> -> , <Identifier> <IDsPrime> | ε")
-       
+    def parseIDsPrime(self, names):
+        self.printProduction(P_IDS_PRIME)
+
         if self.currentToken().type == "separator" and self.currentToken().lexeme == ",":
             self.match("separator", ",")
-            var_name = self.currentToken().lexeme
+            symbol = self.currentToken().symbol
             if not self.match("identifier"):
                 return
-               
-            if var_type:  # Store type if provided
-                self.declareVariable(var_name, var_type)
-            else:  
-                self.declareVariable(var_name, "unknown")
-               
-            self.parseIDsPrime(var_type)
+
+            names.append((symbol, self.site()))
+            self.parseIDsPrime(names)
         else:
-            self.printProduction("<IDsPrime> -> ε")
+            self.printProduction(P_IDS_PRIME_EMPTY)
 
 
 
 
     def parseFunctionCall(self):
-        self.printProduction("<Function Call> -> <Identifier> ( <Arguments> )")
+        self.printProduction(P_FUNCTION_CALL)
 
+        token = self.currentToken()
+        # The function must be defined where it is called
+        call = Call(token.symbol, token.lexeme, self.site())
 
+        if not self.match("identifier"):
+            return call
 
+        if not self.match("separator", "("):
+            return call
 
-        function_name = self.currentToken().lexeme
+        call.opened = True
+        self.parseArguments(call)
+        # Argument counts and types are checked where the argument list ends
+        call.check = self.site()
 
+        if not self.match("separator", ")"):
+            return call
 
+        # Check if this is part of a statement (which needs semicolon)
+        if (self.currentToken().type == "separator" and
+            self.currentToken().lexeme == ";"):
+            self.match("separator", ";")
+        return call
 
 
-        # Check if function is defined
-        if function_name not in self.functions:
-            self.error(f"Function '{function_name}' used before declaration")
-            if not self.match("identifier"):
-                return
-            if not self.match("separator", "("):
-                return
-            self.parseArguments()
-            if not self.match("separator", ")"):
-                return
-            return
 
 
+    def parseArguments(self, call):
+        self.printProduction(P_ARGUMENTS)
 
+        if self.currentToken().type != "separator" or self.currentToken().lexeme != ")":
+            call.arguments.append(self.parseExpression())
+            self.parseArgumentsPrime(call)
+        else:
+            self.printProduction(P_ARGUMENTS_EMPTY)
+            call.tail = self.site()
 
-        # Get function parameter info
-        function_params = self.functions[function_name].get("params", [])
 
 
 
+    def parseArgumentsPrime(self, call):
+        self.printProduction(P_ARGUMENTS_PRIME)
 
-        if not self.match("identifier"):
-            return
+        if self.currentToken().type == "separator" and self.currentToken().lexeme == ",":
+            self.match("separator", ",")
+            call.arguments.append(self.parseExpression())
+            self.parseArgumentsPrime(call)
+        else:
+            self.printProduction(P_ARGUMENTS_PRIME_EMPTY)
+            call.tail = self.site()
 
 
 
 
-        if not self.match("separator", "("):
+    # Semantic analysis - scopes, declarations and type checks, in program order
+    def analyze(self):
+        for section in self.program.sections:
+            self.section = section
+            for statement in section.statements:
+                self.analyzeNode(statement)
+        self.section = None
+
+
+
+
+    def analyzeNode(self, node):
+        return self.analyzers[type(node)](self, node)
+
+
+
+
+    def analyzeDeclaration(self, node):
+        for symbol, site in node.names:
+            self.declareVariable(symbol, node.var_type, site)
+
+
+
+
+    def analyzeFunction(self, node):
+        if node.symbol in self.functions:
+            self.report(node.site, f"Function {node.name} already defined")
+        if node.params is None:
             return
 
+        self.enterScope()
+        for param in node.params:
+            self.declareVariable(param.symbol, param.var_type, param.site)
+        # Add a placeholder for return type - it'll be determined by return statements
+        function = {"params": [(param.name, param.var_type) for param in node.params],
+                    "return_type": "unknown",
+                    "return_types": set()}
+        self.functions[node.symbol] = function
+        self.function_stack.append(function)
+        if node.body is not None:
+            self.analyzeCompound(node.body)
+        self.function_stack.pop()
+        self.exitScope()
 
 
 
-        # Parse arguments and collect their types
-        arg_types = self.parseArguments(expected_count=len(function_params))
 
+    def analyzeCompound(self, node):
+        self.enterScope()
+        for statement in node.statements:
+            self.analyzeNode(statement)
+        self.exitScope()
 
 
 
-        # Validate argument count
-        if len(arg_types) != len(function_params):
-            self.error(f"Function '{function_name}' called with {len(arg_types)} arguments but expects {len(function_params)}")
-        else:
-            # Validate argument types if we have them
-            for i, (arg_type, param) in enumerate(zip(arg_types, function_params)):
-                if arg_type != "unknown" and param[1] != "unknown" and arg_type != param[1]:
-                    if not self.areTypesCompatible(param[1], arg_type):
-                        self.error(f"Type mismatch in function call '{function_name}': argument {i+1} is {arg_type}, but parameter '{param[0]}' expects {param[1]}")
 
+    def analyzeScan(self, node):
+        addresses = []
+        for symbol, var_name, site in node.targets:
+            # Check if variable is declared before scanning
+            if self.lookupVariable(symbol) is None:
+                self.report(site, f"Variable '{var_name}' used in scan procedure without prior declaration.")
+            addresses.append(self.symbol_table.address(symbol))
+        self.addresses[node] = addresses
 
 
 
-        if not self.match("separator", ")"):
+
+    def analyzePrint(self, node):
+        self.analyzeNode(node.expression)
+
+
+
+
+    def analyzeIf(self, node):
+        # Scope for the entire if/else structure
+        self.enterScope()
+        self.analyzeNode(node.condition)
+        if node.complete:
+            # Separate scopes for the if body and the else statement, regardless of curly braces
+            self.enterScope()
+            if node.then_branch is not None:
+                self.analyzeNode(node.then_branch)
+            self.exitScope()
+            if node.has_else:
+                self.enterScope()
+                if node.else_branch is not None:
+                    self.analyzeNode(node.else_branch)
+                self.exitScope()
+        self.exitScope()
+
+
+
+
+    def analyzeWhile(self, node):
+        self.enterScope()
+        self.analyzeNode(node.condition)
+        for statement in node.body:
+            self.analyzeNode(statement)
+        self.exitScope()
+
+
+
+
+    def analyzeCondition(self, node):
+        left_type, left_bare = self.analyzeNode(node.left)
+        right_type, right_bare = self.analyzeNode(node.right)
+
+        # Type checking for comparison operators
+        if left_type != "unknown" and right_type != "unknown" and left_type != right_type:
+            # Special case: Allow comparison between boolean and integer literals 0 and 1 (but cannot be expressions)
+            special_case = False
+            if left_type == "boolean" and right_type == "integer":
+                special_case = right_bare
+            elif right_type == "boolean" and left_type == "integer":
+                special_case = left_bare
+            if not special_case:
+                self.report(node.site, f"Type mismatch: You cannot compare {left_type} with {right_type} using {node.operator}")
+
+
+
+
+    def analyzeReturn(self, node):
+        return_type, bare = self.analyzeNode(node.expression)
+        # Merge the type into the enclosing function's; a return outside any function has none
+        if self.function_stack and return_type != "unknown":
+            function = self.function_stack[-1]
+            function["return_types"].add(return_type)
+            # Returns that disagree leave the return type unknown
+            function["return_type"] = return_type if len(function["return_types"]) == 1 else "unknown"
+
+
+
+
+    def analyzeAssign(self, node):
+        # Check if variable is declared
+        var_type = self.lookupVariable(node.symbol)
+        if var_type is None:
+            self.report(node.site, f"Variable '{node.name}' used before declaration")
+        if node.expression is None:
             return
 
+        expr_type, bare = self.analyzeNode(node.expression)
+        # Type compatibility check; an undeclared variable has already been reported
+        if var_type is not None and expr_type != "unknown" and var_type != "unknown" and var_type != expr_type:
+            if not self.areTypesCompatible(var_type, expr_type, bare):
+                self.report(node.check, f"Type mismatch: Cannot assign {expr_type} value to {var_type} variable '{node.name}'")
+        self.addresses[node] = self.symbol_table.address(node.symbol)
 
 
 
-        # Check if this is part of a statement (which needs semicolon)
-        if (self.currentToken().type == "separator" and
-            self.currentToken().lexeme == ";"):
-            self.match("separator", ";")
 
+    # Expressions are analysed bottom up, each giving its type and whether it is a bare 0 or 1 literal
+    def analyzeBinOp(self, node):
+        left_type, left_bare = self.analyzeNode(node.left)
+        right_type, right_bare = self.analyzeNode(node.right)
+        # Check for boolean operands on either side
+        if left_type == "boolean" or right_type == "boolean":
+            self.report(node.site, f"Cannot use {node.operator} operator with boolean operands")
+        return ("integer", False)
 
 
 
-    def parseArguments(self, expected_count=None):
-        self.printProduction("<Arguments> -> <Expression> <ArgumentsPrime> | ε")
 
+    def analyzeFactor(self, node):
+        if node.kind == "integer":
+            return ("integer", node.value in ["0", "1"])
+        if node.kind == "boolean":
+            return ("boolean", False)
+        if node.kind == "error":
+            return ("unknown", False)
 
+        # Check if variable is declared
+        var_type = self.lookupVariable(node.symbol)
+        if var_type is None and node.symbol not in self.functions:
+            self.report(node.site, f"Variable '{node.value}' used before declaration")
+            return ("unknown", False)
+        self.addresses[node] = self.symbol_table.address(node.symbol)
+        return (var_type if var_type is not None else "unknown", False)
 
 
-        arg_types = []
 
 
+    def analyzeCall(self, node):
+        arg_types = [self.analyzeNode(argument) for argument in node.arguments]
+        if node.symbol not in self.functions:
+            self.report(node.site, f"Function '{node.name}' used before declaration")
+            return ("unknown", False)
 
+        # Get function parameter info
+        function = self.functions[node.symbol]
+        function_params = function.get("params", [])
+        if node.opened:
+            missing = len(function_params) - len(node.arguments)
+            if missing > 0 and node.arguments:
+                self.report(node.tail, f"Too few arguments: expected {missing} more")
+            elif missing > 0:
+                self.report(node.tail, f"Expected {missing} arguments but got 0")
+
+            # Validate argument count
+            if len(node.arguments) != len(function_params):
+                self.report(node.check, f"Function '{node.name}' called with {len(node.arguments)} arguments but expects {len(function_params)}")
+            else:
+                # Validate argument types if we have them
+                for i, ((arg_type, bare), param) in enumerate(zip(arg_types, function_params)):
+                    if arg_type != "unknown" and param[1] != "unknown" and arg_type != param[1]:
+                        if not self.areTypesCompatible(param[1], arg_type, bare):
+                            self.report(node.check, f"Type mismatch in function call '{node.name}': argument {i+1} is {arg_type}, but parameter '{param[0]}' expects {param[1]}")
+        return (function.get("return_type", "unknown"), False)
+
+
+
+
+    # Code generation - assembly for the analysed tree, in program order
+    def generate(self):
+        for section in self.program.sections:
+            self.section = section
+            for statement in section.statements:
+                self.generateNode(statement)
+        self.section = None
+        if self.optimization >= 1:
+            self.peephole_removed = peephole(self.code)
+        self.code.link()
+        self.analysis = analyze_code(self.code)
+        # Code where paths meet must find the stack as deep whichever way it came
+        for index, depth, other in self.analysis.conflicts:
+            if self.code.opcodes[index] != OP_LABEL:
+                continue
+            self.section, site, statement = self.label_sites[self.code.operands[index]]
+            self.report(site, f"Stack depth differs where paths through this {statement} meet: {min(depth, other)} and {max(depth, other)}")
+        self.section = None
 
-        if self.currentToken().type != "separator" or self.currentToken().lexeme != ")":
-            # Save position to determine expression type
-            expr_start_index = self.index
 
 
 
+    def generateNode(self, node):
+        return self.generators[type(node)](self, node)
 
-            self.parseExpression()
 
 
 
+    def placeLabel(self, label, site, statement):
+        # Code may be reached here from elsewhere, so no global is known to hold anything
+        self.code.place(label)
+        self.label_sites[label] = (self.section, site, statement)
+        self.known.clear()
 
-            # Determine the expression type
-            saved_index = self.index
-            self.index = expr_start_index
-            expr_type = self.determineExpressionType()
-            self.index = saved_index
 
 
 
+    def generateDeclaration(self, node):
+        pass
 
-            arg_types.append(expr_type)
 
 
 
+    def generateFunction(self, node):
+        if node.body is not None:
+            self.generateCompound(node.body)
 
-            # Parse the rest of the arguments and collect their types
-            more_arg_types = self.parseArgumentsPrime(expected_count-1 if expected_count is not None else None)
-            arg_types.extend(more_arg_types)
-        else:
-            self.printProduction("<Arguments> -> ε")
-            if expected_count and expected_count > 0:
-                self.error(f"Expected {expected_count} arguments but got 0")
 
 
 
+    def generateCompound(self, node):
+        for statement in node.statements:
+            self.generateNode(statement)
 
-        return arg_types
 
 
 
+    def generateScan(self, node):
+        if not node.complete:
+            return
+        # Append SIN instruction
+        self.code.emit(OP_SIN)
 
-    def parseArgumentsPrime(self, expected_count=None):
-        self.printProduction("<ArgumentsPrime> -> , <Expression> <ArgumentsPrime> | ε")
+        # POPM instructions for each variable in reversed order
+        for mem_addr in reversed(self.addresses[node]):
+            # Add POPM instruction to store the input value into variable's memory location
+            if mem_addr is not None:
+                self.code.emit(OP_POPM, mem_addr)
+                self.known.pop(mem_addr, None)
 
 
 
 
-        arg_types = []
+    def generatePrint(self, node):
+        self.generateNode(node.expression)
+        # Append a SOUT instruction after expression is parsed
+        self.code.emit(OP_SOUT)
 
 
 
 
-        if self.currentToken().type == "separator" and self.currentToken().lexeme == ",":
-            self.match("separator", ",")
+    def generateIf(self, node):
+        holds = self.generateNode(node.condition)
+        if not node.complete:
+            return
 
+        # A condition known while compiling leaves only the branch it picks
+        if holds is not None:
+            branch = node.then_branch if holds else node.else_branch
+            if branch is not None:
+                self.generateNode(branch)
+            return
+
+        # Jump past the 'if' body to a label placed after it when the condition is false
+        else_label = self.code.label()
+        self.code.emit(OP_JMP0, else_label)
+        if node.then_branch is not None:
+            self.generateNode(node.then_branch)
+
+        # If there's an else coming, add a jump to skip it after the 'if' body completes
+        if node.has_else:
+            end_label = self.code.label()
+            self.code.emit(OP_JMP, end_label)
+
+        self.placeLabel(else_label, node.condition.site, "if")
+
+        if node.else_branch is not None:
+            self.generateNode(node.else_branch)
+
+        # Label the end of the if/else structure
+        if node.has_else:
+            self.placeLabel(end_label, node.condition.site, "if")
+
+
+
+
+    def generateWhile(self, node):
+        # Add LABEL at the beginning of while loop
+        start = len(self.code)
+        start_label = self.code.label()
+        self.placeLabel(start_label, node.condition.site, "while")
+        holds = self.generateNode(node.condition)
+        if not node.complete:
+            return
+
+        # A loop whose condition never holds is left out
+        if holds is False:
+            self.code.truncate(start)
+            return
+
+        if holds:
+            # ...and one whose condition always holds never leaves
+            self.warn(node.condition.site, "Infinite loop: condition is always true")
+        else:
+            # Leave the loop for a label placed after it when the condition is false
+            end_label = self.code.label()
+            self.code.emit(OP_JMP0, end_label)
+        for statement in node.body:
+            self.generateNode(statement)
+
+        # Add unconditional JMP back to the condition evaluation
+        self.code.emit(OP_JMP, start_label)
+
+        # Add LABEL for the end of the loop where we jump to if condition is false
+        if not holds:
+            self.placeLabel(end_label, node.condition.site, "while")
+
+
+
+
+    def generateCondition(self, node):
+        """Generate the comparison, or at -O1 return whether it holds if that is already known."""
+        start = len(self.code)
+        self.generateNode(node.left)
+        middle = len(self.code)
+        self.generateNode(node.right)
+        # Add comparison instruction based on type of relational operator
+        opcode = RELOP_OPCODES.get(node.operator)
+        if opcode is None:
+            return None
+        if self.optimization >= 1:
+            left = self.code.constant(start, middle)
+            right = self.code.constant(middle)
+            if left is not None and right is not None:
+                self.code.truncate(start)
+                return comparison(opcode, left, right)
+        self.code.emit(opcode)
+        return None
+
+
+
+
+    def generateReturn(self, node):
+        self.generateNode(node.expression)
 
 
 
-            # Save position to determine expression type
-            expr_start_index = self.index
 
+    def generateAssign(self, node):
+        if node.expression is None:
+            return
+        start = len(self.code)
+        self.generateNode(node.expression)
+        # Add POPM instruction to store the value into variable's memory location
+        mem_addr = self.addresses[node]
+        if mem_addr is not None:
+            if self.optimization >= 1:
+                # Reads of the variable can use a constant stored here until it changes
+                value = self.code.constant(start)
+                if value is not None:
+                    self.known[mem_addr] = value
+                else:
+                    self.known.pop(mem_addr, None)
+            self.code.emit(OP_POPM, mem_addr)
 
 
 
-            self.parseExpression()
+
+    def generateBinOp(self, node):
+        start = len(self.code)
+        self.generateNode(node.left)
+        middle = len(self.code)
+        self.generateNode(node.right)
+        opcode = ARITHMETIC_OPCODES[node.operator]
+        if self.optimization >= 1:
+            # Two constant operands are replaced by what the operation would leave
+            right = self.code.constant(middle)
+            if opcode == OP_D and right == 0:
+                self.report(node.site, "Division by zero")
+            else:
+                left = self.code.constant(start, middle)
+                if left is not None and right is not None:
+                    # A result too big for an operand is left for the code to work out
+                    value = arithmetic(opcode, left, right)
+                    if -(1 << 63) <= value < 1 << 63:
+                        self.code.truncate(start)
+                        self.code.emitValue(value)
+                        return
+        # Add the operation instruction
+        self.code.emit(opcode)
+
 
 
 
+    def generateFactor(self, node):
+        if node.kind == "identifier":
+            mem_addr = self.addresses.get(node)
+            if mem_addr in self.known:
+                self.code.emitValue(self.known[mem_addr])
+            elif mem_addr is not None:
+                self.code.emit(OP_PUSHM, mem_addr)
+        elif node.kind != "error":
+            # Integer literals, and booleans as 0 or 1, are pushed as they are
+            self.code.emitLiteral(node.value)
 
-            # Determine the expression type
-            saved_index = self.index
-            self.index = expr_start_index
-            expr_type = self.determineExpressionType()
-            self.index = saved_index
 
 
 
+    def generateCall(self, node):
+        for argument in node.arguments:
+            self.generateNode(argument)
 
-            arg_types.append(expr_type)
 
 
+def open_report(path, compression=None):
+    """Open the output file for writing, compressed with "gzip" or "zstd" if asked."""
+    if compression == "gzip":
+        return gzip.open(path, "wt", compresslevel=6, encoding="utf-8")
+    if compression == "zstd":
+        try:
+            from compression import zstd
+        except ImportError:
+            raise ValueError("zstd compression needs Python 3.14 or later")
+        return zstd.open(path, "wt", encoding="utf-8")
+    if compression is not None:
+        raise ValueError(f"Unknown compression '{compression}'")
+    return open(path, "w", encoding="utf-8", buffering=REPORT_BUFFER_SIZE)
 
 
-            # parse more arguments
-            more_arg_types = self.parseArgumentsPrime(expected_count-1 if expected_count is not None else None)
-            arg_types.extend(more_arg_types)
+def address_ranges(addresses):
+    """Sorted addresses as text, with runs of consecutive ones written first-last."""
+    # rat25s_client.py has a copy of this, which must stay in sync
+    runs = []
+    for address in addresses:
+        if runs and address == runs[-1][1] + 1:
+            runs[-1][1] = address
         else:
-            self.printProduction("<ArgumentsPrime> -> ε")
-            if expected_count and expected_count > 0:
-                self.error(f"Too few arguments: expected {expected_count} more")
+            runs.append([address, address])
+    return ", ".join(str(first) if first == last else f"{first}-{last}" for first, last in runs)
+
+
+def write_report(out, parser):
+    """Write the trace, symbol table, code analysis and assembly listing of a parsed program to out."""
+    if parser.trace is not None:
+        parser.trace.write(out)
+    out.write("\nSymbol Table:\n")
+    out.write(f"{'Identifier':<20}{'MemoryLocation':<20}Type\n")
+    for symbol, (var_type, memAddr, line) in parser.symbol_table.items():
+        var_name = parser.symbols.name(symbol)
+        out.write(f"{var_name:<20}{memAddr:<20}{var_type:<20}\n")
+
+    # Code is only analysed once it is all generated
+    analysis = parser.analysis
+    if analysis is not None:
+        out.write("\nCode Analysis:\n")
+        out.write(f"{'Max Stack Depth':<20}{analysis.max_depth}\n")
+        out.write(f"{'Memory Used':<20}{len(analysis.addresses)}")
+        if analysis.addresses:
+            out.write(f" ({address_ranges(analysis.addresses)})")
+        out.write("\n")
+
+    out.write("\nAssembly Code Listing:\n")
+    for i, instruction in enumerate(parser.code.listing()):
+        out.write(f"{i + 1:<10} {instruction}\n")
+
+
+
+def compile_file(inputfile, outputfile, optimization=0, compression=None):
+    """Compile one file to its output file in this process.
+
+    Returns (error count, seconds taken, failure or None, messages), where
+    messages is what the lexer and parser printed, such as warnings about
+    invalid tokens, kept for the caller to print in order.
+    """
+    start = time.perf_counter()
+    try:
+        with open(inputfile, "r") as f:
+            source = f.read()
+    except Exception as e:
+        return 0, time.perf_counter() - start, f"Error reading input file: {e}", ""
+    failure = None
+    messages = io.StringIO()
+    trace = TraceWriter()
+    with redirect_stdout(messages):
+        # Identifiers go in an interner of the file's own, so a pool worker does not keep every name it has seen
+        parser = Parser(lex_stream(source, Interner()), observers=[trace], optimization=optimization)
+        try:
+            try:
+                parser.parseProgram()
+            except Exception as e:
+                failure = f"Parsing error: {e}"
+            with open_report(outputfile, compression) as out:
+                write_report(out, parser)
+        except Exception as e:
+            failure = f"Error writing output file: {e}"
+        finally:
+            trace.close()
+    return parser.error_count, time.perf_counter() - start, failure, messages.getvalue()
 
 
 
 
-        return arg_types
+def batch_files(paths):
+    """The input files named by paths, with each directory standing for the .txt files in it that are not outputs."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.endswith(".txt") and not name.startswith("output_"))
+        else:
+            files.append(path)
+    return files
 
 
 
 
+def batch_output(inputfile, compression=None):
+    """Where run_tests.py has always put the output for inputfile: output_<name>.txt next to it."""
+    folder, name = os.path.split(inputfile)
+    stem = name[:-4] if name.endswith(".txt") else name
+    return os.path.join(folder, f"output_{stem}.txt" + COMPRESSED_SUFFIXES.get(compression, ""))
 
 
 
 
-# Token class details
-class Token:
-    def __init__(self, token_type, lexeme, line_number):
-        self.type = token_type
-        self.lexeme = lexeme
-        self.line_number = line_number
+def compile_batch(paths, optimization=0, compression=None, jobs=None):
+    """Compile files, and the .txt files in directories, each to its output_*.txt, across a pool of processes.
+
+    Files are handed to jobs worker processes, the number of cores by
+    default, in chunks, so the interpreter starts once per worker rather
+    than once per file.  A line is printed per file as results come in, in
+    the order given, after anything compiling the file printed, then a
+    summary.  Returns (input, output, error count,
+    seconds, failure) for each file.
+    """
+    inputs = batch_files(paths)
+    outputs = [batch_output(inputfile, compression) for inputfile in inputs]
+    jobs = min(jobs or os.cpu_count() or 1, max(len(inputs), 1))
+    start = time.perf_counter()
+    if jobs == 1:
+        # A pool is not worth starting for one worker
+        results = map(compile_file, inputs, outputs, [optimization] * len(inputs), [compression] * len(inputs))
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(jobs)
+        results = pool.map(compile_file, inputs, outputs, [optimization] * len(inputs), [compression] * len(inputs),
+                           chunksize=max(1, len(inputs) // (jobs * 8)))
+    report = []
+    try:
+        for inputfile, outputfile, (error_count, elapsed, failure, messages) in zip(inputs, outputs, results):
+            # Workers print nothing themselves, so each file's messages come just before its line
+            print(messages, end="")
+            if failure is not None:
+                print(f"{inputfile} -> {outputfile}: {failure} ({elapsed * 1000:.1f} ms)")
+            else:
+                print(f"{inputfile} -> {outputfile}: {error_count} errors ({elapsed * 1000:.1f} ms)")
+            report.append((inputfile, outputfile, error_count, elapsed, failure))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    wall = time.perf_counter() - start
+    busy = sum(result[3] for result in report)
+    failed = sum(result[4] is not None for result in report)
+    with_errors = sum(result[2] > 0 for result in report)
+    print(f"Compiled {len(report)} files in {wall:.2f}s, {jobs} at a time "
+          f"({busy:.2f}s compiling, {len(report) / wall if wall else 0:.0f} files/sec)")
+    print(f"{with_errors} files with errors, {sum(result[2] for result in report)} errors in all, {failed} files failed")
+    return report
 
 
 
@@ -1626,52 +3397,123 @@ class Token:
 def main():
     source = ""
     import sys
-    if len(sys.argv) < 2:
-        print("Usage: python rat25s_parser.py")
+    # Options start with "-"; the rest are the input and output file names
+    options = [arg for arg in sys.argv[1:] if arg.startswith("-")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+    jobs = None
+    for option in options:
+        if option.startswith("--jobs="):
+            jobs = int(option.partition("=")[2])
+    # --serve compiles requests sent over a Unix socket, as rat25s_client.py sends them, until interrupted
+    for option in options:
+        if option == "--serve" or option.startswith("--serve="):
+            from rat25s_server import SERVE_SOCKET, SERVE_TIME_LIMIT, SERVE_MEMORY_LIMIT, serve
+            time_limit = SERVE_TIME_LIMIT
+            memory_limit = SERVE_MEMORY_LIMIT
+            for limit in options:
+                if limit.startswith("--time-limit="):
+                    time_limit = float(limit.partition("=")[2])
+                elif limit.startswith("--memory-limit="):
+                    memory_limit = int(limit.partition("=")[2]) << 20
+            serve(option.partition("=")[2] or SERVE_SOCKET, jobs, time_limit, memory_limit)
+            return
+    if len(args) < 1:
+        print("Usage: python rat25s_parser.py <input file> [output file] [--stream] [--mmap] [--cache[=FILE]] [--compress[=gzip|zstd]] [-O1]")
+        print("       python rat25s_parser.py --batch <files or directories> [--jobs=N] [--compress[=gzip|zstd]] [-O1]")
+        print("       python rat25s_parser.py --serve[=SOCKET] [--jobs=N] [--time-limit=SECONDS] [--memory-limit=MB]")
         return
    
-    inputfile = sys.argv[1]
-    outputfile = "parser_output.txt" if len(sys.argv) < 3 else sys.argv[2]
+    inputfile = args[0]
+    outputfile = "parser_output.txt" if len(args) < 2 else args[1]
+    streaming = "--stream" in options
+    mapped = "--mmap" in options
+    # --cache keeps parsed sections in a file so an edited program only reparses what changed
+    section_cache = None
+    for option in options:
+        if option == "--cache" or option.startswith("--cache="):
+            section_cache = SectionCache(option.partition("=")[2] or SECTION_CACHE_FILE)
+    # --compress writes the output file through gzip, or zstd where Python has it
+    compression = None
+    for option in options:
+        if option == "--compress" or option.startswith("--compress="):
+            compression = option.partition("=")[2] or "gzip"
+    # -O1 cleans up the generated code with the peephole optimizer
+    optimization = 1 if "-O1" in options else 0
+    # --batch compiles every file named, each to its own output_*.txt, across --jobs processes
+    if "--batch" in options:
+        compile_batch(args, optimization, compression, jobs)
+        return
    
     print(f"Parsing {inputfile}...")
    
+    f = None
     try:
-        with open(inputfile, "r") as f:
-            source = f.read()
+        if mapped:
+            # Lex the bytes of the file in place; an empty file cannot be mapped
+            f = open(inputfile, "rb")
+            if os.fstat(f.fileno()).st_size:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                source = b""
+        elif streaming:
+            f = open(inputfile, "r")
+        else:
+            with open(inputfile, "r") as f:
+                source = f.read()
     except Exception as e:
         print(f"Error reading input file: {e}")
         return
    
-    print(f"File read successfully, tokenizing...")
-    tokens = lexer(source)
-    print(f"Found {len(tokens)} tokens, parsing...")
+    if mapped and streaming:
+        tokens = iter_mapped_tokens(source)
+    elif mapped:
+        print(f"File mapped successfully, tokenizing...")
+        tokens = lex_mapped(source)
+    elif streaming:
+        tokens = iter_tokens(f)
+    else:
+        print(f"File read successfully, tokenizing...")
+        tokens = lex_stream(source)
    
-    parser = Parser(tokens)
+    if streaming:
+        # Tokens are lexed as the parser asks for them
+        print(f"Streaming tokens from {inputfile}, parsing...")
+    else:
+        print(f"Found {len(tokens)} tokens, parsing...")
+    # A long trace is spooled as it is made rather than kept as a list of lines
+    trace = TraceWriter()
+    parser = Parser(tokens, section_cache=section_cache, observers=[trace], optimization=optimization)
    
     try:
         parser.parseProgram()
         print("Parsing complete")
+        if optimization:
+            print(f"Peephole optimizer removed {parser.peephole_removed} instructions")
     except Exception as e:
         print(f"Parsing error: {e}")
    
+    if parser.section_cache is not None:
+        print(f"Reused {section_cache.hits} of {section_cache.hits + section_cache.misses} cached sections")
+        try:
+            section_cache.save()
+        except Exception as e:
+            print(f"Error writing section cache: {e}")
+   
     try:
-        with open(outputfile, "w", encoding="utf-8") as out:
-            for line in parser.output_lines:
-                out.write(line + "\n")
-            out.write("\nSymbol Table:\n")
-            out.write(f"{'Identifier':<20}{'MemoryLocation':<20}Type\n")
-            for (var_name, var_type), memAddr in zip(parser.global_vars.items(), parser.memAddrList):
-                out.write(f"{var_name:<20}{memAddr:<20}{var_type:<20}\n")
-
-
-            out.write("\nAssembly Code Listing:\n")
-            for i, instruction in enumerate(parser.assemblyList):
-                out.write(f"{i + 1:<10} {instruction}\n")
+        with open_report(outputfile, compression) as out:
+            write_report(out, parser)
                      
         print(f"Output written to {outputfile}")
     except Exception as e:
         print(f"Error writing output file: {e}")
         return
+    finally:
+        trace.close()
+        # Mapped tokens read their lexemes from the file until this point
+        if f is not None and not f.closed:
+            if isinstance(source, mmap.mmap):
+                source.close()
+            f.close()
    
     if parser.error_count > 0:
         print(f"Parsing completed with {parser.error_count} errors. See {outputfile} for details.")
@@ -0,0 +1,269 @@
+from contextlib import redirect_stdout
+import io
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import socketserver
+import stat
+import time
+
+from rat25s_parser import DiagnosticObserver, Interner, Parser, lex_stream
+
+# Where --serve listens by default
+SERVE_SOCKET = ".rat25s.sock"
+
+# Seconds a request may compile for, and bytes of address space it may take
+# on top of what its worker already uses, before the request fails
+SERVE_TIME_LIMIT = 10
+SERVE_MEMORY_LIMIT = 1 << 30
+
+# Largest request read, in bytes, and seconds a client has to send it
+SERVE_REQUEST_LIMIT = 1 << 26
+SERVE_READ_TIMEOUT = 30
+
+# Seconds past the time limit a request waits for its worker before the worker is killed
+SERVE_GRACE = 5
+
+
+
+
+class CompileTimeout(BaseException):
+    """A request ran past its time limit.  It is not an Exception, so the parser's error recovery lets it through."""
+
+
+
+
+def address_space():
+    """Bytes of address space this process uses, or 0 where /proc cannot tell."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+
+
+def limit_request(memory_limit):
+    """Cap this process's address space at memory_limit bytes more than it uses now."""
+    import resource
+    hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+    limit = address_space() + memory_limit
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+
+
+def work(connection, memory_limit):
+    """The loop of a worker process: compile each request sent down connection and send back its reply."""
+    # Ctrl+C is left to the server, which stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            source, options, time_limit = connection.recv()
+        except EOFError:
+            return
+        if memory_limit:
+            limit_request(memory_limit)
+        connection.send(compile_request(source, options, time_limit))
+
+
+
+
+def compile_request(source, options=(), time_limit=SERVE_TIME_LIMIT):
+    """Compile the source text of a request; return the reply, ready to send as JSON.
+
+    The reply holds the error count, what the lexer and parser printed,
+    such as warnings about invalid tokens, followed by the error and
+    warning lines of the trace, the symbol table as [identifier, address, type] lists, the
+    maximum stack depth and addresses from the code analysis, the
+    assembly listing and the seconds taken.  A request that fails has a
+    failure message, and no more than that if it ran out of time or memory.
+    """
+    start = time.perf_counter()
+    reply = {}
+
+    def expire(signum, frame):
+        raise CompileTimeout
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, time_limit)
+    diagnostics = DiagnosticObserver()
+    messages = io.StringIO()
+    parser = None
+    try:
+        with redirect_stdout(messages):
+            # Identifiers go in an interner of the request's own, so a worker does not keep every name it has seen
+            tokens = lex_stream(source, Interner())
+            parser = Parser(tokens, observers=[diagnostics], optimization=1 if "-O1" in options else 0)
+            parser.parseProgram()
+    except CompileTimeout:
+        return {"failure": f"Compiling took longer than {time_limit}s"}
+    except MemoryError:
+        return {"failure": "Compiling ran out of memory"}
+    except Exception as e:
+        reply["failure"] = f"Parsing error: {e}"
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+    if parser is None:
+        return reply
+
+    reply["errors"] = parser.error_count
+    reply["diagnostics"] = messages.getvalue().splitlines() + diagnostics.lines
+    reply["symbols"] = [[parser.symbols.name(symbol), address, var_type]
+                        for symbol, (var_type, address, line) in parser.symbol_table.items()]
+    if parser.analysis is not None:
+        reply["max_stack_depth"] = parser.analysis.max_depth
+        reply["memory"] = parser.analysis.addresses
+    reply["assembly"] = list(parser.code.listing())
+    reply["elapsed"] = time.perf_counter() - start
+    return reply
+
+
+
+
+class Worker:
+    """A worker process, which compiles requests sent down a pipe one at a time."""
+
+    def __init__(self, context, memory_limit):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=work, args=(child, memory_limit), daemon=True)
+        self.process.start()
+        child.close()
+
+    def compile(self, source, options, time_limit):
+        """The reply to a request, or None if the worker died or took SERVE_GRACE seconds past time_limit."""
+        try:
+            self.connection.send((source, options, time_limit))
+            if self.connection.poll(time_limit + SERVE_GRACE):
+                return self.connection.recv()
+        except (EOFError, OSError):
+            pass
+        return None
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+
+
+class CompileHandler(socketserver.BaseRequestHandler):
+    """Reads one request from a connection and writes its reply."""
+
+    def handle(self):
+        data = self.read()
+        if data is None:
+            # The client stalled or went away, so there is no one to reply to
+            return
+        if len(data) > SERVE_REQUEST_LIMIT:
+            reply = {"failure": f"Request is larger than {SERVE_REQUEST_LIMIT} bytes"}
+        else:
+            try:
+                request = json.loads(data)
+                source = request["source"]
+                options = request.get("options", [])
+                if not isinstance(source, str) or not all(isinstance(option, str) for option in options):
+                    raise TypeError
+            except (ValueError, KeyError, TypeError):
+                reply = {"failure": "Bad request: expected a JSON object with the source text and a list of options"}
+            else:
+                reply = self.server.compile(source, options)
+        try:
+            self.request.sendall(json.dumps(reply).encode("utf-8"))
+        except OSError:
+            pass
+
+
+    def read(self):
+        """The request, up to a byte past SERVE_REQUEST_LIMIT, or None if it does not come within SERVE_READ_TIMEOUT seconds."""
+        deadline = time.monotonic() + SERVE_READ_TIMEOUT
+        chunks = []
+        size = 0
+        try:
+            while size <= SERVE_REQUEST_LIMIT:
+                self.request.settimeout(max(deadline - time.monotonic(), 0.001))
+                chunk = self.request.recv(min(1 << 16, SERVE_REQUEST_LIMIT + 1 - size))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+        except OSError:
+            return None
+        return b"".join(chunks)
+
+
+
+
+class CompileServer(socketserver.ThreadingUnixStreamServer):
+    """Serves compile requests on a Unix socket, compiling them on worker processes.
+
+    A client sends a JSON object with "source", the program text, and
+    "options", a list such as ["-O1"], then shuts down its side of the
+    connection.  The reply is the JSON object compile_request() returns.
+    Each connection gets a thread that takes an idle Worker, so jobs
+    requests compile at a time.  The workers start with the server and
+    serve request after request, so nothing is imported or set up per
+    compile.  Each request may take memory_limit bytes on top of what
+    its worker already uses.  A worker that dies, or that has not replied
+    SERVE_GRACE seconds past the time limit, is killed and replaced.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, jobs=None, time_limit=SERVE_TIME_LIMIT, memory_limit=SERVE_MEMORY_LIMIT):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        # Workers are spawned rather than forked, as replacements start from handler threads
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = [Worker(self.context, memory_limit) for _ in range(self.jobs)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        super().__init__(path, CompileHandler)
+
+
+    def compile(self, source, options):
+        worker = self.idle.get()
+        reply = worker.compile(source, options, self.time_limit)
+        if reply is None:
+            timed_out = worker.process.is_alive()
+            worker.stop()
+            self.workers.remove(worker)
+            worker = Worker(self.context, self.memory_limit)
+            self.workers.append(worker)
+            if timed_out:
+                reply = {"failure": f"Compiling took longer than {self.time_limit}s"}
+            else:
+                reply = {"failure": "The worker compiling the request died"}
+        self.idle.put(worker)
+        return reply
+
+
+    def server_close(self):
+        super().server_close()
+        for worker in self.workers:
+            worker.stop()
+
+
+
+
+def serve(path=SERVE_SOCKET, jobs=None, time_limit=SERVE_TIME_LIMIT, memory_limit=SERVE_MEMORY_LIMIT):
+    """Serve compile requests on a Unix socket at path until interrupted."""
+    # A socket left behind by a server that did not shut down is taken over
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+    with CompileServer(path, jobs, time_limit, memory_limit) as server:
+        print(f"Serving compile requests on {path} with {server.jobs} workers")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
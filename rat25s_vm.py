@@ -0,0 +1,831 @@
+from functools import partial
+import hashlib
+import importlib.util
+import marshal
+import os
+import sys
+import time
+
+from rat25s_parser import (OPCODES, MEMORY_BASE, ARITHMETIC_OPCODES, RELOP_OPCODES,
+                           OP_PUSHI, OP_PUSHM, OP_POPM, OP_JMP0, OP_JMP, OP_SOUT, OP_SIN,
+                           OP_A, OP_S, OP_M, OP_D, OP_LABEL,
+                           CodeBuffer, Parser, analyze_code, arithmetic, comparison, lex_stream)
+
+# Values the operand stack holds before it overflows
+STACK_SIZE = 1 << 16
+
+LISTING_HEADER = "Assembly Code Listing:"
+
+# Where PythonVM keeps the code objects it compiles, by hash of their source
+PYCODE_CACHE_DIR = ".rat25s_pycode"
+
+# Operators deep an expression gets in translated source before it is put in a temporary
+EXPRESSION_DEPTH = 32
+
+
+
+
+class VMError(Exception):
+    """The program cannot go on: bad input, a bad jump or address, division by zero, or the stack out of bounds."""
+
+
+
+
+def load_listing(lines):
+    """A CodeBuffer for listing lines, such as Parser.assemblyList or the numbered lines of an output file."""
+    code = CodeBuffer()
+    names = {name: opcode for opcode, name in enumerate(OPCODES)}
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        # Lines of an output file start with their instruction number
+        if len(fields) > 1 and fields[0].isdigit():
+            fields = fields[1:]
+        opcode = names.get(fields[0])
+        if opcode is None or len(fields) > 2:
+            raise VMError(f"Unknown instruction '{line.strip()}'")
+        if len(fields) == 2:
+            try:
+                value = int(fields[1])
+            except ValueError:
+                raise VMError(f"Bad operand in '{line.strip()}'") from None
+            if -(1 << 63) <= value < 1 << 63:
+                code.emit(opcode, value)
+            else:
+                code.texts[code.emit(opcode)] = fields[1]
+        else:
+            code.emit(opcode)
+    return code
+
+
+
+
+def load_output(path):
+    """A CodeBuffer for the assembly listing at the end of an output file the parser wrote."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() == LISTING_HEADER:
+                return load_listing(f)
+    raise VMError(f"No assembly listing in {path}")
+
+
+
+
+def read_integers(stream):
+    """The whitespace-separated integers in a text stream, one at a time."""
+    for line in stream:
+        for field in line.split():
+            try:
+                yield int(field)
+            except ValueError:
+                raise VMError(f"Input '{field}' is not an integer") from None
+
+
+
+
+class VM:
+    """Runs linked code on the stack machine.
+
+    Memory is a list of words from MEMORY_BASE up to the highest address
+    the code uses, and the operand stack is allocated up front.  Each
+    opcode is carried out by a handler looked up in a table indexed by
+    opcode.  SIN reads a value from stdin for each POPM right after it,
+    which store them last first, and SOUT writes each value on a line of
+    its own to stdout.  Where analyze_code() finds the code safe, the stack
+    is allocated as deep as the code takes it, and pops, addresses and
+    jumps are not checked.
+    """
+
+    def __init__(self, code, stdin=None, stdout=None, stack_size=STACK_SIZE):
+        self.opcodes = bytes(code.opcodes)
+        self.operands = list(code.operands)
+        # Operands too big for the code's array are kept as text there
+        for index, text in code.texts.items():
+            try:
+                self.operands[index] = int(text)
+            except ValueError:
+                # Python will not convert integers of more than sys.get_int_max_str_digits() digits
+                raise VMError(f"Operand of instruction {index + 1} has too many digits to load") from None
+        self.analysis = analyze_code(code)
+        for index, count in self.analysis.inputs.items():
+            self.operands[index] = count
+        # Only code some path reaches is run, so only its addresses need memory
+        addresses = self.analysis.addresses
+        self.memory = [0] * (addresses[-1] - MEMORY_BASE + 1 if addresses else 0)
+        if self.analysis.safe:
+            # Nothing the code does can take the stack, memory or jumps out of bounds
+            stack_size = self.analysis.max_depth
+            self.pop = self.popUnchecked
+            self.address = self.offset
+            self.jump = self.target
+        self.stack = [0] * stack_size
+        self.sp = 0
+        self.inputs = read_integers(stdin if stdin is not None else sys.stdin)
+        self.stdout = stdout if stdout is not None else sys.stdout
+        self.executed = 0
+        self.elapsed = 0.0
+
+        self.handlers = [None] * len(OPCODES)
+        self.handlers[OP_PUSHI] = self.executePushi
+        self.handlers[OP_PUSHM] = self.executePushm
+        self.handlers[OP_POPM] = self.executePopm
+        self.handlers[OP_JMP0] = self.executeJmp0
+        self.handlers[OP_JMP] = self.executeJmp
+        self.handlers[OP_SOUT] = self.executeSout
+        self.handlers[OP_SIN] = self.executeSin
+        self.handlers[OP_LABEL] = self.executeLabel
+        for opcode in ARITHMETIC_OPCODES.values():
+            self.handlers[opcode] = self.arithmeticHandler(opcode)
+        for opcode in RELOP_OPCODES.values():
+            self.handlers[opcode] = self.comparisonHandler(opcode)
+
+
+    def run(self, limit=None):
+        """Run from the first instruction until the code ends, or limit instructions have run; return how many ran."""
+        opcodes, operands, handlers = self.opcodes, self.operands, self.handlers
+        count = len(opcodes)
+        pc = 0
+        executed = 0
+        start = time.perf_counter()
+        try:
+            while pc < count and executed != limit:
+                executed += 1
+                pc = handlers[opcodes[pc]](operands[pc], pc + 1)
+        except IndexError:
+            raise VMError(f"Stack overflow at instruction {pc + 1}") from None
+        finally:
+            self.executed += executed
+            self.elapsed += time.perf_counter() - start
+        return executed
+
+
+    def rate(self):
+        """Instructions run per second so far."""
+        return self.executed / self.elapsed if self.elapsed else 0.0
+
+
+    def push(self, value):
+        self.stack[self.sp] = value
+        self.sp += 1
+
+
+    def pop(self):
+        # Reading below the bottom of the list would wrap around to its end
+        if not self.sp:
+            raise VMError("Stack underflow")
+        self.sp -= 1
+        return self.stack[self.sp]
+
+
+    def popUnchecked(self):
+        self.sp -= 1
+        return self.stack[self.sp]
+
+
+    def address(self, operand):
+        index = operand - MEMORY_BASE
+        if not 0 <= index < len(self.memory):
+            raise VMError(f"Address {operand} is outside memory")
+        return index
+
+
+    def offset(self, operand):
+        return operand - MEMORY_BASE
+
+
+    def jump(self, target):
+        # Targets are instruction numbers, counted from 1
+        if not 1 <= target <= len(self.opcodes):
+            raise VMError(f"Jump to instruction {target}, which does not exist")
+        return target - 1
+
+
+    def target(self, target):
+        return target - 1
+
+
+    # Handlers - each takes its instruction's operand and the index of the next
+    # instruction, and returns the index of the instruction to run after it
+    def executePushi(self, operand, next_pc):
+        self.push(operand)
+        return next_pc
+
+
+    def executePushm(self, operand, next_pc):
+        self.push(self.memory[self.address(operand)])
+        return next_pc
+
+
+    def executePopm(self, operand, next_pc):
+        self.memory[self.address(operand)] = self.pop()
+        return next_pc
+
+
+    def executeJmp0(self, operand, next_pc):
+        if self.pop() == 0:
+            return self.jump(operand)
+        return next_pc
+
+
+    def executeJmp(self, operand, next_pc):
+        return self.jump(operand)
+
+
+    def executeSout(self, operand, next_pc):
+        self.stdout.write(f"{self.pop()}\n")
+        return next_pc
+
+
+    def executeSin(self, operand, next_pc):
+        for _ in range(operand):
+            value = next(self.inputs, None)
+            if value is None:
+                raise VMError(f"Ran out of input at instruction {next_pc}")
+            self.push(value)
+        return next_pc
+
+
+    def executeLabel(self, operand, next_pc):
+        return next_pc
+
+
+    def arithmeticHandler(self, opcode):
+        def execute(operand, next_pc):
+            right = self.pop()
+            left = self.pop()
+            if opcode == OP_D and right == 0:
+                raise VMError(f"Division by zero at instruction {next_pc}")
+            self.push(arithmetic(opcode, left, right))
+            return next_pc
+        return execute
+
+
+    def comparisonHandler(self, opcode):
+        def execute(operand, next_pc):
+            right = self.pop()
+            left = self.pop()
+            self.push(1 if comparison(opcode, left, right) else 0)
+            return next_pc
+        return execute
+
+
+
+
+class ClosureVM(VM):
+    """Runs the same code as VM by compiling it into closures first.
+
+    The code is cut into basic blocks, which start at the first
+    instruction, at jump targets and after jumps.  Each instruction in a
+    block becomes a closure with its operand, memory index or jump target
+    bound when the VM is made, working on a plain list as the stack.  A
+    block ends with a closure that picks the block to run next, so run()
+    only decodes and dispatches once per block.  Input, output and the
+    errors raised are the same as VM's, though the stack size and a limit
+    are only checked between blocks, so a run may go up to a block past
+    either.  Code analyze_code() finds safe has no stack size to check.
+    """
+
+    def __init__(self, code, stdin=None, stdout=None, stack_size=STACK_SIZE):
+        super().__init__(code, stdin, stdout, stack_size)
+        self.stack = []
+        self.stack_size = None if self.analysis.safe else stack_size
+        self.blocks = self.compile()
+
+
+    def compile(self):
+        """The (instruction closures, instruction count, exit closure) of each basic block, in order."""
+        opcodes, operands = self.opcodes, self.operands
+        count = len(opcodes)
+        starts = {0} if count else set()
+        for index, opcode in enumerate(opcodes):
+            if opcode == OP_JMP0 or opcode == OP_JMP:
+                starts.add(index + 1)
+                if 1 <= operands[index] <= count:
+                    starts.add(operands[index] - 1)
+        starts = sorted(start for start in starts if start < count)
+        block_at = {start: number for number, start in enumerate(starts)}
+
+        blocks = []
+        for number, start in enumerate(starts):
+            end = starts[number + 1] if number + 1 < len(starts) else count
+            last = opcodes[end - 1]
+            body_end = end - 1 if last == OP_JMP0 or last == OP_JMP else end
+            steps = tuple(self.closure(opcodes[index], operands[index], index) for index in range(start, body_end))
+            following = block_at.get(end, -1)
+            if body_end == end:
+                exit = self.fallThrough(following)
+            else:
+                target = operands[end - 1]
+                taken = block_at.get(target - 1) if 1 <= target <= count else None
+                if taken is None:
+                    exit = self.badJump(target)
+                elif last == OP_JMP:
+                    exit = self.fallThrough(taken)
+                else:
+                    exit = self.branch(taken, following)
+            blocks.append((steps, end - start, exit))
+        return blocks
+
+
+    def run(self, limit=None):
+        blocks, stack, stack_size = self.blocks, self.stack, self.stack_size
+        block = 0 if blocks else -1
+        executed = 0
+        start = time.perf_counter()
+        try:
+            while block >= 0 and (limit is None or executed < limit):
+                steps, size, exit = blocks[block]
+                for step in steps:
+                    step()
+                executed += size
+                block = exit()
+                if stack_size is not None and len(stack) > stack_size:
+                    raise VMError(f"Stack overflow after {executed} instructions")
+        except IndexError:
+            # Only popping an empty stack indexes out of range
+            raise VMError("Stack underflow") from None
+        finally:
+            self.executed += executed
+            self.elapsed += time.perf_counter() - start
+        return executed
+
+
+    # Block exits - each returns the number of the block to run next, or -1 to stop
+    def fallThrough(self, following):
+        return lambda: following
+
+
+    def branch(self, taken, following):
+        pop = self.stack.pop
+        return lambda: taken if pop() == 0 else following
+
+
+    def badJump(self, target):
+        def exit():
+            raise VMError(f"Jump to instruction {target}, which does not exist")
+        return exit
+
+
+    def closure(self, opcode, operand, index):
+        """A function of no arguments that carries out one instruction."""
+        stack, memory = self.stack, self.memory
+        push, pop = stack.append, stack.pop
+        if opcode == OP_PUSHI:
+            return partial(push, operand)
+        if opcode == OP_PUSHM or opcode == OP_POPM:
+            address = operand - MEMORY_BASE
+            if not 0 <= address < len(memory):
+                def bad():
+                    raise VMError(f"Address {operand} is outside memory")
+                return bad
+            if opcode == OP_PUSHM:
+                return lambda: push(memory[address])
+            def popm():
+                memory[address] = pop()
+            return popm
+        if opcode == OP_SOUT:
+            write = self.stdout.write
+            return lambda: write(f"{pop()}\n")
+        if opcode == OP_SIN:
+            inputs = self.inputs
+            def sin():
+                for _ in range(operand):
+                    value = next(inputs, None)
+                    if value is None:
+                        raise VMError(f"Ran out of input at instruction {index + 1}")
+                    push(value)
+            return sin
+        if opcode == OP_LABEL:
+            return int
+        if opcode == OP_A:
+            return lambda: push(pop() + pop())
+        if opcode == OP_M:
+            return lambda: push(pop() * pop())
+        if opcode == OP_S:
+            return lambda: push(-pop() + pop())
+        if opcode == OP_D:
+            def divide():
+                # Both operands are popped before the divisor is checked, as VM does
+                right = pop()
+                left = pop()
+                if right == 0:
+                    raise VMError(f"Division by zero at instruction {index + 1}")
+                push(arithmetic(OP_D, left, right))
+            return divide
+        def compare():
+            right = pop()
+            push(1 if comparison(opcode, pop(), right) else 0)
+        return compare
+
+
+
+
+class StackValue:
+    """A value the code would have on the stack, as a Python expression.
+
+    reads holds the addresses the expression loads, so it can be worked
+    out before a store changes them.  A comparison also keeps test, the
+    expression to branch on.
+    """
+    __slots__ = ("text", "reads", "test", "depth")
+
+    def __init__(self, text, reads=frozenset(), test=None, depth=0):
+        self.text = text
+        self.reads = reads
+        self.test = test
+        self.depth = depth
+
+
+class PythonTranslator:
+    """Writes a parsed program as the source of a Python function that does what its code does.
+
+    It walks the syntax tree the way Parser.generate() does, but keeps
+    what the code would push on a stack of StackValues, so most values
+    never touch a real stack.  Globals become locals named after their
+    addresses, and while and if become Python loops and branches.  Values
+    still on the stack where control flow meets are pushed onto the real
+    one with push(), and popping an empty stack pops the real one, so
+    code that leaves values behind, as calls and returns do, still runs as
+    the stack machine would run it.
+    """
+
+    def __init__(self, parser, memory_size):
+        self.addresses = parser.addresses
+        self.program = parser.program
+        self.memory_size = memory_size
+        self.lines = []
+        self.indent = 1
+        self.stack = []
+        self.temps = 0
+        self.used = set()  # Addresses the source names
+
+
+    def translate(self):
+        """The source of program(read, write, push, pop), which returns memory when the code ends."""
+        for section in self.program.sections:
+            for statement in section.statements:
+                self.translateNode(statement)
+        self.flush()
+        top = max(self.used, default=MEMORY_BASE - 1) - MEMORY_BASE + 1
+        names = [f"m{MEMORY_BASE + offset}" for offset in range(max(top, self.memory_size))]
+        header = ["def program(read, write, push, pop):"]
+        if names:
+            header.append(f"    {' = '.join(names)} = 0")
+        footer = [f"    return [{', '.join(names[:self.memory_size])}]"]
+        return "\n".join(header + self.lines + footer) + "\n"
+
+
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+
+    def temp(self):
+        self.temps += 1
+        return f"t{self.temps}"
+
+
+    def push(self, value):
+        if value.depth > EXPRESSION_DEPTH:
+            value = self.materialize(value)
+        self.stack.append(value)
+
+
+    def pop(self):
+        if self.stack:
+            return self.stack.pop()
+        name = self.temp()
+        self.emit(f"{name} = pop()")
+        return StackValue(name)
+
+
+    def materialize(self, value):
+        """A value worked out into a temporary now, instead of where it is used."""
+        name = self.temp()
+        self.emit(f"{name} = {value.text}")
+        return StackValue(name)
+
+
+    def flush(self):
+        # Control flow meets here, so values left on the stack go on the real one
+        for value in self.stack:
+            self.emit(f"push({value.text})")
+        self.stack.clear()
+
+
+    def store(self, address, text):
+        # Values that loaded the old contents are worked out before they change
+        for index, value in enumerate(self.stack):
+            if address in value.reads:
+                self.stack[index] = self.materialize(value)
+        self.used.add(address)
+        self.emit(f"m{address} = {text}")
+
+
+    def branchTest(self):
+        """What JMP0 would pop, as the test for falling through rather than jumping."""
+        value = self.pop()
+        self.flush()
+        return value.test if value.test is not None else f"{value.text} != 0"
+
+
+    def block(self, nodes):
+        self.indent += 1
+        start = len(self.lines)
+        for node in nodes:
+            if node is not None:
+                self.translateNode(node)
+        self.flush()
+        if len(self.lines) == start:
+            self.emit("pass")
+        self.indent -= 1
+
+
+    def translateNode(self, node):
+        getattr(self, "translate" + type(node).__name__)(node)
+
+
+    def translateDeclaration(self, node):
+        pass
+
+
+    def translateFunction(self, node):
+        if node.body is not None:
+            self.translateCompound(node.body)
+
+
+    def translateCompound(self, node):
+        for statement in node.statements:
+            self.translateNode(statement)
+
+
+    def translateScan(self, node):
+        if not node.complete:
+            return
+        addresses = [address for address in self.addresses[node] if address is not None]
+        if not addresses:
+            return
+        # Every value is read before any is stored, and the last POPM stores the first value
+        names = [self.temp() for _ in addresses]
+        self.emit(f"{', '.join(names)}, = {', '.join('read()' for _ in names)},")
+        for address, name in reversed(list(zip(addresses, names))):
+            self.store(address, name)
+
+
+    def translatePrint(self, node):
+        self.translateNode(node.expression)
+        self.emit(f'write(f"{{{self.pop().text}}}\\n")')
+
+
+    def translateIf(self, node):
+        self.translateNode(node.condition)
+        if not node.complete:
+            return
+        self.emit(f"if {self.branchTest()}:")
+        self.block([node.then_branch])
+        if node.has_else:
+            self.emit("else:")
+            self.block([node.else_branch])
+
+
+    def translateWhile(self, node):
+        self.flush()
+        if not node.complete:
+            self.translateNode(node.condition)
+            return
+        # The condition goes in the loop's head if it takes no statements to work out
+        lines, self.lines = self.lines, []
+        self.indent += 1
+        self.translateNode(node.condition)
+        test = self.branchTest()
+        self.indent -= 1
+        condition, self.lines = self.lines, lines
+        if condition:
+            self.emit("while True:")
+            self.lines.extend(condition)
+            self.emit(f"    if not ({test}):")
+            self.emit("        break")
+        else:
+            self.emit(f"while {test}:")
+        self.block(node.body)
+
+
+    def translateCondition(self, node):
+        self.translateNode(node.left)
+        self.translateNode(node.right)
+        operator = PYTHON_RELOPS.get(node.operator)
+        if operator is None:
+            return
+        right = self.pop()
+        left = self.pop()
+        test = f"{left.text} {operator} {right.text}"
+        self.push(StackValue(f"(1 if {test} else 0)", left.reads | right.reads, test,
+                             max(left.depth, right.depth) + 1))
+
+
+    def translateReturn(self, node):
+        self.translateNode(node.expression)
+
+
+    def translateAssign(self, node):
+        if node.expression is None:
+            return
+        self.translateNode(node.expression)
+        address = self.addresses[node]
+        if address is not None:
+            self.store(address, self.pop().text)
+
+
+    def translateBinOp(self, node):
+        self.translateNode(node.left)
+        self.translateNode(node.right)
+        right = self.pop()
+        left = self.pop()
+        if node.operator != "/":
+            self.push(StackValue(f"({left.text} {node.operator} {right.text})", left.reads | right.reads,
+                                 depth=max(left.depth, right.depth) + 1))
+            return
+        # Division can fail, so it happens where the code does it; D truncates toward zero
+        if left.reads or left.depth:
+            left = self.materialize(left)
+        if right.reads or right.depth:
+            right = self.materialize(right)
+        if not right.text.isdigit():
+            self.emit(f"if {right.text} == 0:")
+            self.emit('    raise VMError("Division by zero")')
+        elif int(right.text) == 0:
+            self.emit('raise VMError("Division by zero")')
+        name = self.temp()
+        self.emit(f"{name} = {left.text} // {right.text} if ({left.text} < 0) == ({right.text} < 0) "
+                  f"else -(-{left.text} // {right.text})")
+        self.push(StackValue(name))
+
+
+    def translateFactor(self, node):
+        if node.kind == "identifier":
+            address = self.addresses.get(node)
+            if address is not None:
+                self.used.add(address)
+                self.push(StackValue(f"m{address}", frozenset([address])))
+        elif node.kind != "error":
+            self.push(StackValue(str(int(node.value))))
+
+
+    def translateCall(self, node):
+        for argument in node.arguments:
+            self.translateNode(argument)
+
+
+PYTHON_RELOPS = {"==": "==", "!=": "!=", ">": ">", "<": "<", "<=": "<=", "=>": ">="}
+
+
+class PythonVM(VM):
+    """Runs a parsed program as a Python function compiled from it by PythonTranslator.
+
+    Compiled code objects are marshalled into cache_dir, named by a hash
+    of their source and the Python version, so running the same program
+    again skips compile().  Input, output and memory are the same as VM's.
+    Nothing is counted per instruction, so executed stays 0, and there is
+    no limit or stack size.  Programs with errors are not translated.
+    """
+
+    def __init__(self, parser, stdin=None, stdout=None, cache_dir=PYCODE_CACHE_DIR):
+        if parser.error_count:
+            raise VMError("Only programs without errors can be translated to Python")
+        super().__init__(parser.code, stdin, stdout)
+        self.source = PythonTranslator(parser, len(self.memory)).translate()
+        self.cache_dir = cache_dir
+        self.cached = False
+        self.function = self.load()
+
+
+    def load(self):
+        """The compiled program() function, from the cache if it is there."""
+        key = hashlib.sha256(importlib.util.MAGIC_NUMBER + self.source.encode("utf-8")).hexdigest()
+        path = os.path.join(self.cache_dir, key + ".bin") if self.cache_dir is not None else None
+        code = None
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    code = marshal.load(f)
+                self.cached = True
+            except (OSError, EOFError, ValueError, TypeError):
+                code = None
+        if code is None:
+            try:
+                code = compile(self.source, "<rat25s>", "exec")
+            except (SyntaxError, RecursionError, MemoryError) as e:
+                raise VMError(f"Program cannot be compiled as Python: {e}") from None
+            if path is not None:
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    temp_path = path + ".tmp"
+                    with open(temp_path, "wb") as f:
+                        marshal.dump(code, f)
+                    os.replace(temp_path, path)
+                except OSError:
+                    pass
+        namespace = {"VMError": VMError}
+        exec(code, namespace)
+        return namespace["program"]
+
+
+    def run(self, limit=None):
+        # The translated program does not count instructions, so it cannot stop after a number of them
+        if limit is not None:
+            raise VMError("The python engine cannot stop after a number of instructions")
+        inputs = self.inputs
+        def read():
+            value = next(inputs, None)
+            if value is None:
+                raise VMError("Ran out of input")
+            return value
+        stack = []
+        start = time.perf_counter()
+        try:
+            self.memory = self.function(read, self.stdout.write, stack.append, stack.pop)
+        except IndexError:
+            raise VMError("Stack underflow") from None
+        finally:
+            self.elapsed += time.perf_counter() - start
+        return self.executed
+
+
+
+
+# Engines main() can run code with
+ENGINES = {"closure": ClosureVM, "table": VM, "python": PythonVM}
+
+
+
+
+def main():
+    # Options start with "-"; the rest are the file to run and the file SIN reads
+    options = [arg for arg in sys.argv[1:] if arg.startswith("-")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+    if len(args) < 1:
+        print("Usage: python rat25s_vm.py <output file | source file> [input file] [-O1] [--limit=N] [--engine=closure|table|python]")
+        return
+
+    limit = None
+    engine = ClosureVM
+    for option in options:
+        if option.startswith("--limit="):
+            limit = int(option.partition("=")[2])
+        elif option.startswith("--engine="):
+            engine = ENGINES.get(option.partition("=")[2])
+            if engine is None:
+                print(f"Unknown engine in {option}; use one of {', '.join(ENGINES)}")
+                return
+
+    if limit is not None and engine is PythonVM:
+        print("The python engine does not count instructions, so it cannot take --limit", file=sys.stderr)
+        return
+
+    path = args[0]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+    except Exception as e:
+        print(f"Error reading {path}: {e}", file=sys.stderr)
+        return
+
+    # An output file is run from its listing; anything else is compiled first
+    parser = None
+    if LISTING_HEADER in text:
+        if engine is PythonVM:
+            print("The python engine runs source files, not output files", file=sys.stderr)
+            return
+        code = load_listing(text.split(LISTING_HEADER, 1)[1].splitlines())
+    else:
+        parser = Parser(lex_stream(text), observers=[], optimization=1 if "-O1" in options else 0)
+        start = time.perf_counter()
+        parser.parseProgram()
+        print(f"Compiled {path} in {time.perf_counter() - start:.3f}s", file=sys.stderr)
+        if parser.error_count:
+            print(f"Compiled with {parser.error_count} errors; running the code anyway", file=sys.stderr)
+        code = parser.code
+
+    stdin = open(args[1], "r") if len(args) > 1 else sys.stdin
+    try:
+        # The python engine translates the parsed program rather than its code
+        vm = engine(parser if engine is PythonVM else code, stdin=stdin)
+        vm.run(limit)
+    except VMError as e:
+        print(f"Runtime error: {e}", file=sys.stderr)
+        return
+    finally:
+        if stdin is not sys.stdin:
+            stdin.close()
+        sys.stdout.flush()
+    if engine is PythonVM:
+        print(f"Ran in {vm.elapsed:.3f}s{' from the code cache' if vm.cached else ''}", file=sys.stderr)
+    else:
+        print(f"Executed {vm.executed} instructions in {vm.elapsed:.3f}s ({vm.rate():,.0f} instructions/sec)",
+              file=sys.stderr)
+
+
+
+
+if __name__ == "__main__":
+    main()